@@ -0,0 +1,215 @@
+#
+# Times each stage of the conversion on synthetic tdr files, and records its peak memory
+# PYTHONPATH=. python benchmarks/benchmark_stages.py --output results.json [--compare previous.json]
+# from the top of the repository, or with tdrconvert installed by pip install -e .
+#
+import argparse
+import contextlib
+import h5py
+import itertools
+import json
+import numpy
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from tdrconvert import all_info
+from tdrconvert import read_tdr
+from tdrconvert import synthetic_tdr
+from tdrconvert import write_exodus
+from tdrconvert import write_gmsh
+from tdrconvert import write_tetgen
+
+def measure(stages, name, function, repeat):
+    '''
+      the time is the best of repeat runs, the peak memory is traced in an extra run
+      the messages printed by the stage are discarded
+    '''
+    times = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(repeat):
+            start = time.perf_counter()
+            result = function()
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        function()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    stages[name] = {
+        'time' : min(times),
+        'peak_memory' : peak,
+    }
+    print("  %-30s %10.4f s %10.1f MB" % (name, min(times), peak / 1024**2))
+    return result
+
+def get_vertex(geometry):
+    vertex = geometry['vertex']
+    if len(vertex.dtype) == 3:
+        return vertex['x', 'y', 'z']
+    return vertex['x', 'y']
+
+def get_reference_elements(group):
+    '''
+      the element table of a region with one element type, decoded with a plain reshape of elements_0
+    '''
+    stream = group['elements_0'][()]
+    shape, dim, n = read_tdr.element_shapes[int(stream[0])]
+    table = stream.reshape(-1, n + 1)
+    if numpy.any(table[:, 0] != stream[0]):
+        raise RuntimeError('%s has more than one element type' % group.name)
+    return shape, table[:, 1:]
+
+def get_reference_face_count(elements, nnodes, volume):
+    '''
+      the faces of a volume are those used by exactly one simplex, the faces of a contact are its distinct elements
+    '''
+    if volume:
+        n = elements.shape[1]
+        faces = numpy.vstack([elements[:, list(x)] for x in itertools.combinations(range(n), n - 1)])
+    else:
+        faces = elements
+    faces = numpy.sort(faces, axis=1).astype(numpy.int64)
+    if nnodes ** faces.shape[1] < 2**63:
+        keys = numpy.zeros(len(faces), dtype=numpy.int64)
+        for c in range(faces.shape[1]):
+            keys = keys * nnodes + faces[:, c]
+        keys, counts = numpy.unique(keys, return_counts=True)
+    else:
+        keys, counts = numpy.unique(faces, axis=0, return_counts=True)
+    return int(numpy.sum(counts == 1)) if volume else len(keys)
+
+def check_regions(geometry, regions, nnodes):
+    '''
+      compares the decoded elements and extracted faces with a plain numpy decode, so that a fast but wrong stage is not benchmarked
+    '''
+    for r in regions:
+        shape, elements = get_reference_elements(geometry['region_%d' % r['index']])
+        if not numpy.array_equal(r['elements'][shape], elements):
+            raise RuntimeError('the elements of %s are not decoded correctly' % r['name'])
+        faces = get_reference_face_count(elements, nnodes, r['type'] == 0)
+        if faces != len(r['surface_keys']):
+            raise RuntimeError('%s has %d faces instead of %d' % (r['name'], len(r['surface_keys']), faces))
+
+def read_closed(tdr):
+    '''
+      the mesh of every timed run is closed, so that no file handles are left open between runs
+    '''
+    with read_tdr.read_tdr(tdr, 1.0, False) as mesh:
+        return mesh
+
+def benchmark_file(tdr, work_dir, repeat):
+    stages = {}
+    with h5py.File(tdr, 'r') as f:
+        geometry = f['collection']['geometry_0']
+        nregions = geometry.attrs['number of regions']
+
+        vertex = get_vertex(geometry)
+        coordinates = measure(stages, 'get_coordinates', lambda: read_tdr.get_coordinates(vertex, 1.0), repeat)
+        nnodes = len(coordinates)
+
+        # the elements are decoded from the hdf5 datasets, as read_tdr does
+        regions = measure(stages, 'process_region', lambda: [read_tdr.process_region(geometry, i) for i in range(nregions)], repeat)
+        bulk = [x for x in regions if x['type'] == 0]
+        def extract_surfaces():
+            for r in bulk:
+                read_tdr.extract_surface_from_volume(r, nnodes)
+        measure(stages, 'extract_surface_from_volume', extract_surfaces, repeat)
+        for r in regions:
+            if r['type'] != 0:
+                read_tdr.extract_surface_from_contact(r, nnodes)
+        check_regions(geometry, regions, nnodes)
+
+        face_index = measure(stages, 'get_face_index', lambda: read_tdr.get_face_index(regions), repeat)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            read_tdr.update_boundary_regions(regions, face_index, nnodes)
+        measure(stages, 'find_interfaces', lambda: read_tdr.find_interfaces(regions, face_index, nnodes), repeat)
+
+    data = measure(stages, 'read_tdr', lambda: read_closed(tdr), repeat)
+    # the mesh of the last run is opened again for its datasets
+    with data:
+        data.device_name = 'device'
+        data.datasets = measure(stages, 'load_datasets', lambda: read_tdr.load_datasets(data), repeat)
+        info = measure(stages, 'get_info_from_tdr_data', lambda: all_info.get_info_from_tdr_data('device', data), repeat)
+
+        basename = os.path.join(work_dir, 'benchmark')
+        for gmsh_format in write_gmsh.gmsh_formats:
+            measure(stages, 'write_gmsh_' + gmsh_format,
+                    lambda: write_gmsh.write_gmsh(filename=basename + '.msh', all_info=info, gmsh_format=gmsh_format), repeat)
+        measure(stages, 'write_tetgen', lambda: write_tetgen.write_tetgen(basename=basename, all_info=info), repeat)
+        measure(stages, 'write_exodus', lambda: write_exodus.write_exodus(filename=basename + '.exo', all_info=info, data=data), repeat)
+    return stages
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous):
+    '''
+      prints the time and memory of each stage relative to a previous run
+    '''
+    cases = {(x['dimension'], x['requested_elements']) : x for x in previous['results']}
+    print("compared to %s" % previous.get('commit'))
+    for r in results['results']:
+        p = cases.get((r['dimension'], r['requested_elements']))
+        if p is None:
+            continue
+        print("%dD %d elements" % (r['dimension'], r['elements']))
+        for name, s in r['stages'].items():
+            if name not in p['stages']:
+                continue
+            ps = p['stages'][name]
+            print("  %-30s time x%-8.3f memory x%-8.3f" % (name,
+                s['time'] / ps['time'] if ps['time'] else float('nan'),
+                s['peak_memory'] / ps['peak_memory'] if ps['peak_memory'] else float('nan')))
+
+def run():
+    parser = argparse.ArgumentParser(description='Benchmark the stages of tdr conversion')
+    parser.add_argument('--elements',   help='comma separated element counts', default='10000,1000000,10000000')
+    parser.add_argument('--dimensions', help='comma separated dimensions', default='2,3')
+    parser.add_argument('--regions',    help='number of bulk regions', type=int, default=2)
+    parser.add_argument('--repeat',     help='number of timed runs for each stage', type=int, default=1)
+    parser.add_argument('--work_dir',   help='directory for the tdr and output files, a temporary directory by default', required=False)
+    parser.add_argument('--output',     help='the json file to write the results to', required=False)
+    parser.add_argument('--compare',    help='a json file from a previous run to compare against', required=False)
+    args = parser.parse_args()
+
+    results = {
+        'commit' : get_commit(),
+        'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python' : platform.python_version(),
+        'numpy' : numpy.__version__,
+        'h5py' : h5py.__version__,
+        'machine' : platform.machine(),
+        'results' : [],
+    }
+
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        for dimension in [int(x) for x in args.dimensions.split(',')]:
+            for nelements in [int(x) for x in args.elements.split(',')]:
+                tdr = os.path.join(work_dir, 'benchmark.tdr')
+                cells = synthetic_tdr.get_cells(dimension, nelements)
+                info = synthetic_tdr.write_synthetic_tdr(tdr, cells, nregions=args.regions)
+                print("%dD %d nodes %d elements" % (dimension, info['nodes'], info['elements']))
+                results['results'].append({
+                    'dimension' : dimension,
+                    'requested_elements' : nelements,
+                    'elements' : info['elements'],
+                    'nodes' : info['nodes'],
+                    'tdr_size' : os.path.getsize(tdr),
+                    'stages' : benchmark_file(tdr, work_dir, args.repeat),
+                })
+
+    if args.output:
+        with open(args.output, 'w') as ofh:
+            json.dump(results, ofh, indent=2)
+    if args.compare:
+        with open(args.compare) as ifh:
+            compare(results, json.load(ifh))
+
+if __name__ == "__main__":
+    run()
@@ -18,27 +18,55 @@ class PhysicalGroup:
             etype = 4 # 4-node tetrahedron
         self.etype = etype
 
+# simplex shape from the number of element nodes
+simplex_shapes = {
+    1 : 'points',
+    2 : 'edges',
+    3 : 'triangles',
+    4 : 'tetrahedra',
+}
+
 class RegionInfo:
-    def __init__(self, node_to_coordinates, elements, transform_elements):
+    def __init__(self, node_to_coordinates, elements, transform_elements, blocks=None):
         self.node_to_coordinates = node_to_coordinates
-        if transform_elements:
+        if blocks is not None:
+            # the (shape, elements) of each element shape of a tdr region
+            # elements is only set when there is one shape
+            self.blocks = blocks
+            self.elements = blocks[0][1] if len(blocks) == 1 else None
+        elif transform_elements:
             self.elements = transform_nodes_to_coordinates(node_to_coordinates, elements)
+            self.blocks = get_simplex_blocks(self.elements)
         else:
-            # 1 based indexing for gmsh, tetgen, exodus
-            self.elements = elements[:] + 1
+            # 0 based, the writers add 1 for gmsh, tetgen, exodus
+            self.elements = elements
+            self.blocks = get_simplex_blocks(self.elements)
 
 class BoundaryInfo:
-    def __init__(self, node_to_coordinates, elements, transform_elements):
+    def __init__(self, node_to_coordinates, elements, transform_elements, blocks=None):
         self.node_to_coordinates = node_to_coordinates
-        if transform_elements:
+        if blocks is not None:
+            self.blocks = blocks
+            self.elements = blocks[0][1] if len(blocks) == 1 else None
+        elif transform_elements:
             self.elements = transform_nodes_to_coordinates(node_to_coordinates, elements)
+            self.blocks = get_simplex_blocks(self.elements)
         else:
-            # 1 based indexing for gmsh, tetgen, exodus
-            self.elements = elements[:] + 1
+            # 0 based, the writers add 1 for gmsh, tetgen, exodus
+            self.elements = elements
+            self.blocks = get_simplex_blocks(self.elements)
+
+def get_simplex_blocks(elements):
+    '''
+      the devsim elements are one block of simplexes
+    '''
+    if len(elements) == 0:
+        return []
+    return [(simplex_shapes[len(elements[0])], elements)]
 
 def transform_nodes_to_coordinates(node_to_coordinates, elements):
-    # GMSH is a 1 based system
-    out_elements = node_to_coordinates[elements] + 1
+    # 0 based, the writers add 1 for gmsh, tetgen, exodus
+    out_elements = node_to_coordinates[elements]
     return out_elements
 
 def get_physical_groups(device):
@@ -107,19 +135,14 @@ def get_coordinates(device, region_info):
         region_max_coordinate = max(region.node_to_coordinates)
         max_coordinate = max(max_coordinate, region_max_coordinate)
 
-    coordinates = [None] * (max_coordinate + 1)
+    coordinates = np.zeros((max_coordinate + 1, 3))
 
     # collection of coordinates
     axis_names = ['x', 'y', 'z']
     for region in regions:
         node_coordinates = region_info[region].node_to_coordinates
-        axis = []
-        for i in axis_names:
-            axis.append(ds.get_node_model_values(device=device, region=region, name=i))
-
-        axis_values = list(zip(*axis))
-        for ic, rc in enumerate(node_coordinates):
-            coordinates[rc] = axis_values[ic]
+        for i, n in enumerate(axis_names):
+            coordinates[node_coordinates, i] = ds.get_node_model_values(device=device, region=region, name=n)
 
     return coordinates
 
@@ -194,20 +217,20 @@ def get_tdr_device_info(device, data):
     region_info = {}
     interface_info = {}
 
-    for r in data['regions']:
+    for r in data.regions:
         name = r['name']
         typename = r['typename']
         if typename == 'contact':
             contact_info[name] = {
                 'name'     : name,
-                'region' : data['regions'][r['bulk 0']]['name'],
+                'region' : data.regions[r['bulk 0']]['name'],
                 'material' : r['material'],
             }
         elif typename == 'interface':
             interface_info[name] = {
                 'name'     : name,
-                'region0'  : data['regions'][r['bulk 0']]['name'],
-                'region1'  : data['regions'][r['bulk 1']]['name'],
+                'region0'  : data.regions[r['bulk 0']]['name'],
+                'region1'  : data.regions[r['bulk 1']]['name'],
             }
         elif typename == 'region':
             region_info[name] = {
@@ -220,7 +243,7 @@ def get_tdr_device_info(device, data):
         'regions': region_info,
         'contacts': contact_info,
         'interfaces': interface_info,
-        'dimension': data['dimension'],
+        'dimension': data.dimension,
     }
     return device_info
 
@@ -231,13 +254,13 @@ def get_info_from_tdr_data(device, data):
     #
     # groups
     #
-    dim = data['dimension']
+    dim = data.dimension
     #contacts = ds.get_contact_list(device=device)
     #interfaces = ds.get_interface_list(device=device)
     #dim = ds.get_dimension(device=device)
     groups = {}
     index = 1
-    for r in data['regions']:
+    for r in data.regions:
         name = r['name']
         # TODO: worry about name conflicts later
         if r['typename'] in ('contact', 'interface'):
@@ -247,22 +270,19 @@ def get_info_from_tdr_data(device, data):
         index += 1
 
     region_info = {}
-    vname = read_tdr.get_shape_name(dim)
-    for r in data['regions']:
+    for r in data.regions:
         if r['typename'] == 'region':
-            e =r['elements']
-            region_info[r['name']] = RegionInfo(node_to_coordinates=None, elements=e[vname], transform_elements=False)
+            blocks = read_tdr.get_element_blocks(r['elements'])
+            region_info[r['name']] = RegionInfo(node_to_coordinates=None, elements=None, transform_elements=False, blocks=blocks)
 
     boundary_info = {}
 
-    sname = read_tdr.get_shape_name(dim-1)
-    for r in data['regions']:
+    for r in data.regions:
         if r['typename'] in ('contact', 'interface'):
-            e =r['elements']
-            boundary_info[r['name']] = BoundaryInfo(node_to_coordinates=None, elements=e[sname], transform_elements=False)
+            blocks = read_tdr.get_element_blocks(r['elements'])
+            boundary_info[r['name']] = BoundaryInfo(node_to_coordinates=None, elements=None, transform_elements=False, blocks=blocks)
 
-    coordinates = data['coordinates']
-    coordinates = coordinates.reshape(-1, 3)
+    coordinates = data.coordinates
 
     all_info = {
         'coordinates' : coordinates,
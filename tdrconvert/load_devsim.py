@@ -1,4 +1,18 @@
-try:
-    from devsim import *
-except:
-    print("WARNING: devsim module is not loaded, this may be an issue for some uses of the program")
+#
+# devsim is imported the first time one of its functions is used, through this module
+# so that conversions which do not need devsim neither load it nor require it
+#
+import importlib
+
+devsim = None
+
+def __getattr__(name):
+    global devsim
+    if name.startswith('__'):
+        raise AttributeError(name)
+    if devsim is None:
+        try:
+            devsim = importlib.import_module('devsim')
+        except ImportError as e:
+            raise ImportError("the devsim module is required for the --devsim, --tecplot, --vtk and --old options") from e
+    return getattr(devsim, name)
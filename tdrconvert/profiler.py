@@ -0,0 +1,247 @@
+#
+# Per stage wall clock, cpu time, peak rss and tracemalloc report
+# the stages are no-ops unless a profile has been started
+#
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# the profile being recorded, there is at most one per process
+active = None
+
+def get_peak_rss():
+    '''
+      the peak resident set size of the process in bytes, or None when it is not available
+    '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+def start(cprofile_stage=None, trace_memory=False):
+    '''
+      tracemalloc slows down stages making many small python objects, so it is optional
+    '''
+    global active
+    if active is not None:
+        raise RuntimeError("A profile is already being recorded")
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    active = {
+        'stages' : {},
+        'stack' : [],
+        'cprofile_stage' : cprofile_stage,
+        'cprofile' : cProfile.Profile() if cprofile_stage else None,
+        'started_tracing' : started_tracing,
+        'wall' : time.perf_counter(),
+        'cpu' : time.process_time(),
+    }
+    return active
+
+def stop():
+    '''
+      returns the profile, with the totals for the whole run
+    '''
+    global active
+    profile = active
+    active = None
+    if profile is None:
+        raise RuntimeError("No profile is being recorded")
+    profile['wall'] = time.perf_counter() - profile['wall']
+    profile['cpu'] = time.process_time() - profile['cpu']
+    profile['peak_rss'] = get_peak_rss()
+    if tracemalloc.is_tracing():
+        profile['tracemalloc_peak'] = tracemalloc.get_traced_memory()[1]
+    if profile['started_tracing']:
+        tracemalloc.stop()
+    return profile
+
+@contextlib.contextmanager
+def profiling(cprofile_stage=None, trace_memory=False):
+    start(cprofile_stage=cprofile_stage, trace_memory=trace_memory)
+    profile = active
+    try:
+        yield profile
+    finally:
+        stop()
+
+def update_traced_peak(stack):
+    '''
+      the tracemalloc peak is reset when a stage starts, so every open stage keeps its own maximum
+    '''
+    if not tracemalloc.is_tracing():
+        return
+    peak = tracemalloc.get_traced_memory()[1]
+    for s in stack:
+        s['traced_peak'] = max(s['traced_peak'], peak)
+    tracemalloc.reset_peak()
+
+def get_record(profile, name):
+    '''
+      the record of the stage name within the current stage
+    '''
+    stack = profile['stack']
+    path = '/'.join([x['path'] for x in stack[-1:]] + [name])
+    record = profile['stages'].get(path)
+    if record is None:
+        record = {
+            'name' : name,
+            'path' : path,
+            'depth' : len(stack),
+            'calls' : 0,
+            'wall' : 0.0,
+            'cpu' : 0.0,
+            'peak_rss' : None,
+            'peak_rss_increase' : None,
+            'tracemalloc_peak' : None,
+            'tracemalloc_increase' : None,
+            'counts' : {},
+        }
+        profile['stages'][path] = record
+    return record
+
+@contextlib.contextmanager
+def stage(name):
+    '''
+      times the enclosed code, and yields a dict for its counts
+      a stage entered more than once accumulates its times and counts
+    '''
+    profile = active
+    if profile is None:
+        yield {}
+        return
+
+    stack = profile['stack']
+    record = get_record(profile, name)
+
+    update_traced_peak(stack)
+    current = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+    frame = {
+        'path' : record['path'],
+        'traced_peak' : 0 if current is None else current,
+    }
+    stack.append(frame)
+    rss = get_peak_rss()
+    cprofile = profile['cprofile'] if name == profile['cprofile_stage'] else None
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    if cprofile:
+        cprofile.enable()
+    try:
+        yield record['counts']
+    finally:
+        if cprofile:
+            cprofile.disable()
+        record['calls'] += 1
+        record['wall'] += time.perf_counter() - wall
+        record['cpu'] += time.process_time() - cpu
+        update_traced_peak(stack)
+        stack.pop()
+        if rss is not None:
+            peak_rss = get_peak_rss()
+            record['peak_rss'] = peak_rss
+            record['peak_rss_increase'] = (record['peak_rss_increase'] or 0) + peak_rss - rss
+        if current is not None:
+            record['tracemalloc_peak'] = max(record['tracemalloc_peak'] or 0, frame['traced_peak'] - current)
+            record['tracemalloc_increase'] = (record['tracemalloc_increase'] or 0) + tracemalloc.get_traced_memory()[0] - current
+
+def get_worker_options():
+    '''
+      the options for a worker process to record its own profile, None when no profile is being recorded
+    '''
+    if active is None:
+        return None
+    return {
+        'trace_memory' : tracemalloc.is_tracing(),
+    }
+
+def add_maximum(x, y):
+    if y is None:
+        return x
+    return y if x is None else max(x, y)
+
+def add_total(x, y):
+    if y is None:
+        return x
+    return y if x is None else x + y
+
+def merge(stages):
+    '''
+      adds the stages recorded in a worker process within the current stage
+      the times and counts of the workers are summed, so their wall time is more than the elapsed time
+      the peak memory is that of the largest worker
+    '''
+    profile = active
+    if profile is None or not stages:
+        return
+    stack = profile['stack']
+    # the stages of the worker are in the order they were entered, so a parent is merged before its children
+    paths = {}
+    for s in stages:
+        parent = s['path'].rpartition('/')[0]
+        if parent:
+            stack.append({'path' : paths[parent]})
+        record = get_record(profile, s['name'])
+        if parent:
+            stack.pop()
+        paths[s['path']] = record['path']
+        record['calls'] += s['calls']
+        record['wall'] += s['wall']
+        record['cpu'] += s['cpu']
+        record['peak_rss'] = add_maximum(record['peak_rss'], s['peak_rss'])
+        record['peak_rss_increase'] = add_maximum(record['peak_rss_increase'], s['peak_rss_increase'])
+        record['tracemalloc_peak'] = add_maximum(record['tracemalloc_peak'], s['tracemalloc_peak'])
+        record['tracemalloc_increase'] = add_total(record['tracemalloc_increase'], s['tracemalloc_increase'])
+        count(record['counts'], **s['counts'])
+
+def count(counts, **kwargs):
+    '''
+      adds to the counts yielded by stage
+    '''
+    for k, v in kwargs.items():
+        counts[k] = counts.get(k, 0) + int(v)
+
+def get_report(profile, **kwargs):
+    report = dict(kwargs)
+    report.update({
+        'wall' : profile['wall'],
+        'cpu' : profile['cpu'],
+        'peak_rss' : profile.get('peak_rss'),
+        'tracemalloc_peak' : profile.get('tracemalloc_peak'),
+        'stages' : list(profile['stages'].values()),
+    })
+    return report
+
+def print_report(report):
+    print("%-45s %6s %10s %10s %12s %12s" % ('stage', 'calls', 'wall (s)', 'cpu (s)', 'rss (MB)', 'traced (MB)'))
+    for s in report['stages']:
+        print("%-45s %6d %10.4f %10.4f %12s %12s" % (
+            '  ' * s['depth'] + s['name'], s['calls'], s['wall'], s['cpu'],
+            '' if s['peak_rss'] is None else '%.1f' % (s['peak_rss'] / 1024**2),
+            '' if s['tracemalloc_peak'] is None else '%.1f' % (s['tracemalloc_peak'] / 1024**2)))
+    print("%-45s %6s %10.4f %10.4f" % ('total', '', report['wall'], report['cpu']))
+
+def write_report(profile, filename, **kwargs):
+    '''
+      writes the json report, and the cProfile stats of the selected stage next to it
+    '''
+    report = get_report(profile, **kwargs)
+    if profile['cprofile']:
+        report['cprofile'] = os.path.splitext(filename)[0] + '_' + profile['cprofile_stage'] + '.prof'
+        profile['cprofile'].dump_stats(report['cprofile'])
+    with open(filename, 'w') as ofh:
+        json.dump(report, ofh, indent=2)
+    return report
@@ -1,36 +1,96 @@
+import concurrent.futures
 import h5py
+import multiprocessing
 import numpy
+import os
 import sys
 from . import load_devsim as ds
+from . import profiler
+from . import tdr_mesh
+from . import topology_cache
 
 compress_opts = {
     "compression" : "gzip",
 }
 
 
-def process_elements(data, Type):
-    # a line
-    if (data[0] == 1) and (numpy.unique(data[0::3]).shape[0] == 1):
-        dimension = 1
-    # a triangle
-    elif (data[0] == 2) and (numpy.unique(data[0::4]).shape[0] == 1):
-        dimension = 2
-    # a tetrahedron 5
-    elif (data[0] == 5) and (numpy.unique(data[0::5]).shape[0] == 1):
-        dimension = 3
-    else:
+# number of values read from elements_0 at a time, rounded down to whole elements
+chunk_values = 1 << 18
+
+# tdr element type code and its shape, dimension and number of nodes
+# the codes are in the order of the element blocks of a region
+element_shapes = {
+    1 : ('edges', 1, 2),
+    2 : ('triangles', 2, 3),
+    3 : ('quadrangles', 2, 4),
+    5 : ('tetrahedra', 3, 4),
+    6 : ('pyramids', 3, 5),
+    7 : ('prisms', 3, 6),
+    8 : ('hexahedra', 3, 8),
+}
+
+# the element shapes in block order
+shape_names = ('points',) + tuple(x[0] for x in element_shapes.values())
+
+def mark_nodes(nodes, block):
+    '''
+      marks the nodes of the block, the mask grows when the block has a larger node
+    '''
+    if block.size == 0:
+        return nodes
+    nmax = block.max() + 1
+    if nmax > len(nodes):
+        nodes = numpy.concatenate((nodes, numpy.zeros(nmax - len(nodes), dtype=bool)))
+    nodes[block] = True
+    return nodes
+
+def process_elements(data, Type, nnodes=0, dtype=None):
+    '''
+      Decodes the type tagged element stream, from a numpy array or an hdf5 dataset
+      The stream is read in slices into the preallocated connectivity,
+      and the nodes of the region are marked as each slice is read
+      A numpy array of the index dtype is not copied, its connectivity is a strided view
+      A stream with more than one element type is decoded by process_mixed_elements
+    '''
+    if len(data) == 0 or data[0] not in element_shapes:
         raise RuntimeError("can't process elements")
+    code = data[0]
+    ename, dimension, nodes_per_element = element_shapes[code]
+    # the first and every nodes_per_element + 1 element after that is the element type
+    width = nodes_per_element + 1
+    if len(data) % width != 0:
+        return process_mixed_elements(data, nnodes, dtype)
 
-    ename = get_shape_name(dimension)
+    nelements = len(data) // width
+    dtype = numpy.dtype(dtype or data.dtype)
+    if isinstance(data, numpy.ndarray) and data.dtype == dtype:
+        table = data.reshape(-1, width)
+        # view of the table of coordinates indexes, skipping the type column
+        new_array = table[:, 1:]
+    else:
+        table = None
+        # table of coordinates indexes for each element
+        new_array = numpy.empty((nelements, nodes_per_element), dtype=dtype)
+    nodes = numpy.zeros(nnodes, dtype=bool)
+    # whole hdf5 chunks, when they are larger than chunk_values
+    chunks = getattr(data, 'chunks', None)
+    rows = max(1, max(chunk_values, chunks[0] if chunks else 0) // width)
+    for start in range(0, nelements, rows):
+        stop = min(start + rows, nelements)
+        if table is None:
+            block = numpy.asarray(data[start*width:stop*width]).reshape(-1, width)
+        else:
+            block = table[start:stop]
+        if numpy.any(block[:, 0] != code):
+            return process_mixed_elements(data, nnodes, dtype)
+        block = block[:, 1:]
+        if table is None:
+            new_array[start:stop] = block
+        nodes = mark_nodes(nodes, block)
 
-    # the first and every dimension + 2 element after that is the element type
-    new_array = numpy.delete(data, numpy.s_[0::dimension+2])
-    # sort unique to get the coordinates indexes for region
+    # the sorted coordinates indexes for region
     # this is a direct mapping for datasets later
-    coordinates = numpy.unique(new_array)
-    # reshape as table of coordinates indexes for a triangle or tetrahedron
-    # -1 is the unknown
-    new_array = numpy.reshape(new_array, (-1, dimension+1))
+    coordinates = numpy.flatnonzero(nodes).astype(dtype)
 
     ret = {
         'dim' : dimension,
@@ -39,90 +99,358 @@ def process_elements(data, Type):
     }
     return ret
 
-def process_regions(geometry):
-    nregions = geometry.attrs['number of regions']
-    dimension = geometry.attrs['dimension']
-
-    regions=[]
-    for i in range(nregions):
-        md = {}
-        data = geometry['region_%d' % i]
-        md['index'] = i
-        md['hdf'] = data
-        md['name'] = data.attrs['name'].decode('ascii')
-        Type = data.attrs['type']
-        if data.attrs['number of parts'] != 1:
-            raise RuntimeError("Expecting only 1 part in region %d" % i)
-        md['elements'] = process_elements(data['elements_0'][()], Type)
-        #print md['elements']
-        #0 bulk
-        #1 contact
-        #2 interface
-        md['type'] = Type
-        if Type == 0:
-            md['typename'] = "region"
-            md['material'] = data.attrs['material'].decode('ascii')
-        elif Type == 1:
-            md['typename'] = "contact"
-            md['material'] = "metal"
-            md['bulk 0'] = data.attrs['bulk 0']
-        elif Type == 2:
-            md['typename'] = "interface"
-            md['bulk 0'] = data.attrs['bulk 0']
-
-            md['bulk 1'] = data.attrs['bulk 1']
+def get_element_starts(stream):
+    '''
+      Returns the position of the type code of every element in the stream
+      Every position is treated as a type code, which jumps past the nodes of its element
+      The positions reached from the start are found by doubling the jumps,
+      so the number of passes over the stream is logarithmic in the number of elements
+    '''
+    n = len(stream)
+    # number of values of each element, including its type code
+    sizes = numpy.zeros(max(element_shapes) + 1, dtype=numpy.int64)
+    for code, (ename, dimension, nodes_per_element) in element_shapes.items():
+        sizes[code] = nodes_per_element + 1
+    itype = numpy.int32 if n + 2 <= numpy.iinfo(numpy.int32).max else numpy.int64
+    # n is the end of the stream, and n + 1 is reached from an unknown type code or past the end
+    jump = numpy.full(n + 2, n + 1, dtype=itype)
+    jump[n] = n
+    position = numpy.flatnonzero((stream >= 0) & (stream < len(sizes)))
+    target = position + sizes[stream[position]]
+    valid = (target > position + 1) & (target <= n)
+    jump[position[valid]] = target[valid]
+
+    # starts holds the positions reached in fewer than 2**k jumps from the start,
+    # and jump holds 2**k jumps
+    starts = numpy.zeros(1, dtype=itype)
+    while True:
+        reached = jump[starts]
+        if numpy.any(reached == n + 1):
+            raise RuntimeError("can't process elements")
+        reached = reached[reached < n]
+        if len(reached) == 0:
+            return starts
+        starts = numpy.concatenate((starts, reached))
+        jump = jump[jump]
+
+def process_mixed_elements(data, nnodes=0, dtype=None):
+    '''
+      Decodes a type tagged element stream with more than one element type
+      The elements are grouped by type into one connectivity table for each shape,
+      'order' has the position in the stream of each element in block order, for element data
+    '''
+    stream = numpy.asarray(data[()] if not isinstance(data, numpy.ndarray) else data)
+    dtype = numpy.dtype(dtype or stream.dtype)
+    starts = get_element_starts(stream)
+    codes = stream[starts]
+    present = [x for x in element_shapes if numpy.any(codes == x)]
+    dimensions = set([element_shapes[x][1] for x in present])
+    if len(dimensions) != 1:
+        raise RuntimeError("can't process elements of more than one dimension")
+
+    ret = {
+        'dim' : dimensions.pop(),
+    }
+    nodes = numpy.zeros(nnodes, dtype=bool)
+    order = []
+    for code in present:
+        ename, dimension, nodes_per_element = element_shapes[code]
+        index = numpy.flatnonzero(codes == code)
+        table = stream[starts[index, None] + numpy.arange(1, nodes_per_element + 1)]
+        ret[ename] = table.astype(dtype, copy=False)
+        nodes = mark_nodes(nodes, table)
+        order.append(index)
+    ret['coordinates'] = numpy.flatnonzero(nodes).astype(dtype)
+    if len(order) > 1:
+        ret['order'] = numpy.concatenate(order)
+    return ret
+
+def get_element_blocks(elements):
+    '''
+      Returns the (shape, table) of every element shape of a region, in block order
+    '''
+    return [(x, elements[x]) for x in shape_names if x in elements]
+
+def get_number_of_elements(elements):
+    return sum([len(x[1]) for x in get_element_blocks(elements)])
+
+def get_element_stream(data):
+    '''
+      Returns the elements_0 dataset of a region with one part
+      The streams of every part are read and concatenated into one array, in part order
+    '''
+    nparts = data.attrs.get('number of parts', 1)
+    if nparts == 1:
+        return data['elements_0']
+    parts = [data['elements_%d' % p] for p in range(nparts)]
+    stream = numpy.empty(sum([len(x) for x in parts]), dtype=numpy.result_type(*[x.dtype for x in parts]))
+    offset = 0
+    for x in parts:
+        if len(x):
+            x.read_direct(stream, dest_sel=numpy.s_[offset:offset+len(x)])
+        offset += len(x)
+    return stream
+
+def process_region(geometry, i, index_dtype=None):
+    md = {}
+    data = geometry['region_%d' % i]
+    md['index'] = i
+    md['name'] = data.attrs['name'].decode('ascii')
+    Type = data.attrs['type']
+    with profiler.stage('decode_elements') as counts:
+        # only the shape of the vertex dataset is read
+        md['elements'] = process_elements(get_element_stream(data), Type, len(geometry['vertex']), index_dtype)
+        profiler.count(counts, elements=get_number_of_elements(md['elements']))
+    #print md['elements']
+    #0 bulk
+    #1 contact
+    #2 interface
+    md['type'] = Type
+    if Type == 0:
+        md['typename'] = "region"
+        md['material'] = data.attrs['material'].decode('ascii')
+    elif Type == 1:
+        md['typename'] = "contact"
+        md['material'] = "metal"
+        md['bulk 0'] = data.attrs['bulk 0']
+    elif Type == 2:
+        md['typename'] = "interface"
+        md['bulk 0'] = data.attrs['bulk 0']
+
+        md['bulk 1'] = data.attrs['bulk 1']
+
+    else:
+        raise RuntimeError("Can't process type %d" % Type)
+    return md
 
+def process_region_topology(geometry, i, nnodes, index_dtype=None):
+    '''
+      decode the region elements and extract its surface
+    '''
+    md = process_region(geometry, i, index_dtype)
+    with profiler.stage('extract_surface') as counts:
+        if md['type'] == 0:
+            extract_surface_from_volume(md, nnodes)
         else:
-            raise RuntimeError("Can't process type %d" % Type)
-        regions.append(md)
+            extract_surface_from_contact(md, nnodes)
+        profiler.count(counts, faces=len(md['surface_keys']))
+    return md
+
+def process_region_in_worker(filename, geometry_name, i, nnodes, index_dtype=None, profile=None):
+    '''
+      runs in a worker process, which opens its own read only file handle
+      with the profile options, the stages of the worker are returned for the profile of the parent
+    '''
+    if profile is None:
+        with h5py.File(filename, 'r') as f:
+            return process_region_topology(f[geometry_name], i, nnodes, index_dtype), None
+    with profiler.profiling(**profile) as worker_profile:
+        with h5py.File(filename, 'r') as f:
+            md = process_region_topology(f[geometry_name], i, nnodes, index_dtype)
+    return md, list(worker_profile['stages'].values())
+
+def get_jobs(jobs):
+    '''
+      0 or less uses all of the cores
+    '''
+    if jobs is None:
+        return 1
+    if jobs <= 0:
+        return os.cpu_count() or 1
+    return jobs
+
+def get_index_dtype(index_dtype, nnodes):
+    '''
+      None keeps the integer type of the tdr file
+      a smaller type is only used when every node index fits in it
+    '''
+    if index_dtype is None:
+        return None
+    index_dtype = numpy.dtype(index_dtype)
+    if nnodes - 1 > numpy.iinfo(index_dtype).max:
+        print("%d nodes do not fit in %s indexes, using int64" % (nnodes, index_dtype))
+        return numpy.dtype(numpy.int64)
+    return index_dtype
+
+def set_index_dtype(regions, index_dtype):
+    '''
+      converts the element tables which are not already of the index dtype
+      the order of mixed elements is an element number, so it is left as it is
+    '''
+    for r in regions:
+        elements = r['elements']
+        for k, v in elements.items():
+            if k not in ('dim', 'order'):
+                elements[k] = v.astype(index_dtype, copy=False)
+
+def process_regions(geometry, nnodes, jobs=1, index_dtype=None):
+    '''
+      decode the elements and extract the surface of every region
+      with jobs > 1, the regions are processed in a process pool
+    '''
+    nregions = geometry.attrs['number of regions']
+    jobs = min(get_jobs(jobs), nregions)
+
+    if jobs <= 1:
+        return [process_region_topology(geometry, i, nnodes, index_dtype) for i in range(nregions)]
+
+    print("Processing %d regions with %d jobs" % (nregions, jobs))
+    filename = geometry.file.filename
+    # the file is open in this process, so the workers are spawned instead of forked from it
+    # and open the file by its path
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+        profile = profiler.get_worker_options()
+        futures = [executor.submit(process_region_in_worker, filename, geometry.name, i, nnodes, index_dtype, profile) for i in range(nregions)]
+        regions = []
+        for x in futures:
+            md, stages = x.result()
+            profiler.merge(stages)
+            regions.append(md)
     return regions
 
-def get_intersection_elements(intersection):
+def get_face_keys(faces, nnodes):
     '''
-      Takes a set and returns a numpy array
+      Takes an (F, n) table of faces with sorted nodes and packs each row into one key
+      The key is an int64 when nnodes**n fits, otherwise it is a void of the big endian row
+      Both keep the lexicographic order of the rows
     '''
-    return numpy.array(sorted(intersection))
+    width = faces.shape[1]
+    if nnodes ** width <= numpy.iinfo(numpy.int64).max:
+        keys = numpy.zeros(len(faces), dtype=numpy.int64)
+        for i in range(width):
+            keys *= nnodes
+            keys += faces[:, i]
+        return keys
+    faces = numpy.ascontiguousarray(faces, dtype='>i8')
+    return faces.view(numpy.dtype((numpy.void, 8 * width))).ravel()
 
-def remove_interfaces_at_contact(regions):
+def get_faces_from_keys(keys, width, nnodes):
     '''
-      get a list of all contact nodes and remove interfaces that contain them
+      Inverse of get_face_keys, returns an (F, width) table of faces
     '''
+    if keys.dtype != numpy.int64:
+        return keys.view('>i8').reshape(-1, width).astype(numpy.int64)
+    faces = numpy.empty((len(keys), width), dtype=numpy.int64)
+    keys = keys.copy()
+    for i in reversed(range(width)):
+        keys, faces[:, i] = numpy.divmod(keys, nnodes)
+    return faces
+
+def get_key_base(width, nnodes):
+    '''
+      faces of 4 nodes may be triangles padded with the node number nnodes
+    '''
+    return nnodes + 1 if width == 4 else nnodes
+
+def get_padded_faces(blocks, nnodes, width=0):
+    '''
+      Stacks the (shape, table) blocks of faces into one table at least width wide
+      Rows with fewer nodes are padded with nnodes, which sorts after every node
+    '''
+    tables = [x[1] for x in blocks]
+    width = max([width] + [x.shape[1] for x in tables])
+    if len(tables) == 1 and tables[0].shape[1] == width:
+        return tables[0]
+    dtype = numpy.result_type(numpy.min_scalar_type(nnodes), *tables)
+    faces = numpy.full((sum([len(x) for x in tables]), width), nnodes, dtype=dtype)
+    offset = 0
+    for x in tables:
+        faces[offset:offset+len(x), :x.shape[1]] = x
+        offset += len(x)
+    return faces
+
+def get_elements_from_keys(keys, width, nnodes, source=None):
+    '''
+      Takes a sorted array of face keys and returns the elements of the faces
+      The keys only have the sorted nodes of a face, so the node order of quadrangles
+      is looked up in the surface of the source region
+    '''
+    faces = get_faces_from_keys(keys, width, get_key_base(width, nnodes))
+    if width != 4:
+        return {
+            'dim' : width - 1,
+            get_shape_name(width - 1) : faces,
+        }
+    elements = {
+        'dim' : 2,
+    }
+    triangles = faces[:, 3] == nnodes
+    if numpy.any(triangles):
+        elements['triangles'] = faces[triangles, :3]
+    if not numpy.all(triangles):
+        elements['quadrangles'] = source['quads'][numpy.searchsorted(source['quad_keys'], keys[~triangles])]
+    return elements
+
+def remove_interfaces_at_contact(regions, nnodes):
+    '''
+      mark all contact nodes and remove interface elements that contain them
+    '''
+    contact_nodes = numpy.zeros(nnodes, dtype=bool)
     contacts = [x for x in regions if x['type'] == 1]
-    all_contact_nodes = set([])
     for contact in contacts:
-        surface_set = contact['surface_set']
-        for i in surface_set:
-            all_contact_nodes.update(i)
+        for shape, faces in get_element_blocks(contact['elements']):
+            contact_nodes[faces] = True
 
     interfaces = [x for x in regions if x['type'] == 2]
     for interface in interfaces:
-        surface_set = interface['surface_set']
-        new_set = set([])
-        # i is the tuple of one surface element
-        for i in surface_set:
-            if all_contact_nodes.intersection(i):
-                continue
-            else:
-                new_set.add(i)
-        if not new_set:
+        elements = interface['elements']
+        nfaces = get_number_of_elements(elements)
+        nkeep = 0
+        for shape, faces in get_element_blocks(elements):
+            keep = ~numpy.any(contact_nodes[faces], axis=1)
+            count = numpy.count_nonzero(keep)
+            if count == 0:
+                del elements[shape]
+            elif count != len(faces):
+                elements[shape] = faces[keep]
+            nkeep += count
+        if nkeep == 0:
             raise RuntimeError("Interface %s disappeared!" % (interface['name']))
-        elif new_set != surface_set:
-            interface['surface_set'] = new_set
-            dim = interface['elements']['dim']
-            shape_name = get_shape_name(dim)
-            interface['elements'][shape_name] = get_intersection_elements(new_set)
-            print("INTERFACE %s from %d to %d elements" % (interface['name'], len(surface_set), len(new_set)))
+        elif nkeep != nfaces:
+            extract_surface_from_contact(interface, nnodes)
+            print("INTERFACE %s from %d to %d elements" % (interface['name'], nfaces, nkeep))
 
 
-def split_contacts(regions, contact):
+def get_face_index(regions):
+    '''
+      Concatenates the surface keys of every bulk region, tagged with the region index,
+      and sorts them by key
+      A face shared by two regions appears in two consecutive rows
+    '''
+    rlist = [r for r in regions if r['type'] == 0]
+    keys = numpy.concatenate([r['surface_keys'] for r in rlist])
+    region = numpy.repeat([r['index'] for r in rlist], [len(r['surface_keys']) for r in rlist])
+    # stable so that shared faces are ordered by region index
+    order = numpy.argsort(keys, kind='stable')
+    return {
+        'keys' : keys[order],
+        'region' : region[order],
+        'width' : rlist[0]['surface_width'],
+    }
+
+def get_contact_attachment(face_index, contact):
+    '''
+      Returns the contact face numbers and the bulk regions they are on
+      A face on an interface is listed for both regions
+    '''
+    keys = face_index['keys']
+    contact_surface = contact['surface_keys']
+    lo = numpy.searchsorted(keys, contact_surface, side='left')
+    hi = numpy.searchsorted(keys, contact_surface, side='right')
+    faces = numpy.repeat(numpy.arange(len(contact_surface)), hi - lo)
+    rows = numpy.repeat(hi - numpy.cumsum(hi - lo), hi - lo) + numpy.arange(len(faces))
+    return faces, face_index['region'][rows]
+
+def split_contacts(regions, contact, faces, attached, nnodes, width):
     contacts = []
-    contact_surface = contact['surface_set']
+    contact_surface = contact['surface_keys']
     for region in regions:
         if region['type'] != 0:
             continue
-        region_surface = region['surface_set']
-        intersection = region_surface.intersection(contact_surface)
-        if intersection:
+        # the contact keys are sorted, so are the selected faces
+        intersection = contact_surface[faces[attached == region['index']]]
+        if len(intersection):
             new_contact_name = contact['name'] + "_" + region['name']
             print("%s and %s intersect with %d elements!" % (region['name'], contact['name'], len(intersection)))
             print("Creating %s" % new_contact_name)
@@ -133,38 +461,37 @@ def split_contacts(regions, contact):
                 'material' : 'metal',
                 'bulk 0' : region['index'],
                 'bulk 0 name' : region['name'],
-                'surface_set' : intersection,
-            }
-            dim = contact['elements']['dim']
-            new_elements = get_intersection_elements(intersection)
-            shape = get_shape_name(dim)
-            c['elements'] =  {
-                'dim' : dim,
-                shape : new_elements,
+                'surface_keys' : intersection,
+                'surface_width' : width,
             }
+            c['elements'] = get_elements_from_keys(intersection, width, nnodes, contact)
             contacts.append(c)
     return contacts
 
-def update_boundary_regions(regions):
+def update_boundary_regions(regions, face_index, nnodes):
     contacts_to_add = []
     for r in regions:
         if r['type'] == 1:
             r0 = r['bulk 0']
-            if is_contact_in_region(regions[r0], r):
+            faces, attached = get_contact_attachment(face_index, r)
+            # a region contains the contact when it has every contact face
+            counts = numpy.bincount(attached, minlength=len(regions))
+            nfaces = len(r['surface_keys'])
+            if counts[r0] == nfaces:
                 r['bulk 0 name'] = regions[r0]['name']
             else:
                 print("bulk 0 reference %s for contact %s is not correct searching for proper connection" % (regions[r0]['name'], r['name']))
                 found = False
                 for r2 in regions:
                     if r2['type'] == 0:
-                        if is_contact_in_region(r2, r):
+                        if counts[r2['index']] == nfaces:
                             r['bulk 0'] = r2['index']
                             r['bulk 0 name'] = r2['name']
                             print("bulk 0 reference for contact %s has been updated to %s" % (r['name'], r2['name']))
                             found = True
                             break
                 if not found:
-                    new_contacts = split_contacts(regions, r)
+                    new_contacts = split_contacts(regions, r, faces, attached, nnodes, face_index['width'])
                     contacts_to_add.append((r['index'], new_contacts))
                     if not new_contacts:
                         raise RuntimeError("Could not find attachment for contact " + r['name'])
@@ -184,64 +511,100 @@ def update_boundary_regions(regions):
             i['index'] = index
             regions.append(i)
 
-def is_contact_in_region(region, contact_region):
-    intersection = region['surface_set'].intersection(contact_region['surface_set'])
-    if len(intersection) == len(contact_region['surface_set']):
-        return True
-    return False
+# local nodes of each face of a volume shape, quadrangle faces go around the face
+shape_faces = {
+    'triangles' : ((1, 2), (0, 2), (0, 1)),
+    'quadrangles' : ((0, 1), (1, 2), (2, 3), (3, 0)),
+    'tetrahedra' : ((1, 2, 3), (0, 2, 3), (0, 1, 3), (0, 1, 2)),
+    'pyramids' : ((0, 1, 2, 3), (0, 1, 4), (1, 2, 4), (2, 3, 4), (3, 0, 4)),
+    'prisms' : ((0, 1, 2), (3, 4, 5), (0, 1, 4, 3), (1, 2, 5, 4), (2, 0, 3, 5)),
+    'hexahedra' : ((0, 1, 2, 3), (4, 5, 6, 7), (0, 1, 5, 4), (1, 2, 6, 5), (2, 3, 7, 6), (3, 0, 4, 7)),
+}
+
+def get_volume_faces(blocks, nnodes):
+    '''
+      Returns the faces of every element of the (shape, table) blocks, in the node order of the face
+    '''
+    faces = []
+    for shape, table in blocks:
+        local = shape_faces[shape]
+        for n in sorted(set([len(x) for x in local])):
+            columns = [x for x in local if len(x) == n]
+            faces.append((shape, table[:, columns].reshape(-1, n)))
+    return get_padded_faces(faces, nnodes)
+
+def get_boundary_faces(blocks, nnodes):
+    '''
+      Takes the (shape, table) blocks of a volume
+      and returns the (F, n) table of faces used by exactly one element
+      each face has sorted nodes and the rows are in sorted order
+      For faces of 4 nodes, the faces with their nodes in face order are returned too
+    '''
+    faces = get_volume_faces(blocks, nnodes)
+    ordered = faces if faces.shape[1] == 4 else None
+    faces = numpy.sort(faces, axis=1)
+    # lexsort uses the last key as the primary key
+    order = numpy.lexsort(faces.T[::-1])
+    faces = faces[order]
+    if len(faces) == 0:
+        return faces, ordered
+    # a new face starts wherever a row differs from the previous one
+    starts = numpy.ones(len(faces), dtype=bool)
+    starts[1:] = numpy.any(faces[1:] != faces[:-1], axis=1)
+    starts = numpy.flatnonzero(starts)
+    counts = numpy.diff(numpy.append(starts, len(faces)))
+    starts = starts[counts == 1]
+    if ordered is not None:
+        ordered = ordered[order[starts]]
+    return faces[starts], ordered
+
+def set_surface(region, keys, width, ordered, nnodes):
+    '''
+      keys are the sorted keys of the surface faces
+      the quadrangles in face order are kept for the faces found from their keys
+    '''
+    region['surface_keys'] = keys
+    region['surface_width'] = width
+    if ordered is not None:
+        quads = ordered[:, 3] != nnodes
+        region['quad_keys'] = keys[quads]
+        region['quads'] = ordered[quads]
 
-def extract_surface_from_volume(region):
+def extract_surface_from_volume(region, nnodes):
     '''
       find surface elements
     '''
     elements = region['elements']
     dim = elements['dim']
-    if dim == 3:
-        volume = elements['tetrahedra']
-        surface_type = 'triangles'
-    elif dim == 2:
-        volume = elements['triangles']
-        surface_type = 'edges'
-    else:
+    if dim not in (2, 3):
         raise RuntimeError("ISSUE GETTING SURFACE")
-    surface_dim = dim - 1
-
-    surface = set([])
-    duplicates = set([])
-    new_elements = []
-    for row in volume:
-        nodes = sorted(list(row))
-        if dim == 3:
-            new_elements.append((nodes[0], nodes[1], nodes[2]))
-            new_elements.append((nodes[0], nodes[1], nodes[3]))
-            new_elements.append((nodes[0], nodes[2], nodes[3]))
-            new_elements.append((nodes[1], nodes[2], nodes[3]))
-        elif dim == 2:
-            new_elements.append((nodes[0], nodes[1]))
-            new_elements.append((nodes[0], nodes[2]))
-            new_elements.append((nodes[1], nodes[2]))
-
-    for n in new_elements:
-        if n in duplicates:
-            continue
-        elif n in surface:
-            surface.remove(n)
-            duplicates.add(n)
-        else:
-            surface.add(n)
+    faces, ordered = get_boundary_faces(get_element_blocks(elements), nnodes)
+    width = faces.shape[1]
+    # the faces are already sorted and unique
+    set_surface(region, get_face_keys(faces, get_key_base(width, nnodes)), width, ordered, nnodes)
 
-    region['surface_set'] = surface
+def extract_surface_from_contact(region, nnodes):
+    faces = get_padded_faces(get_element_blocks(region['elements']), nnodes)
+    width = faces.shape[1]
+    keys = get_face_keys(numpy.sort(faces, axis=1), get_key_base(width, nnodes))
+    if width != 4:
+        set_surface(region, numpy.unique(keys), width, None, nnodes)
+        return
+    keys, index = numpy.unique(keys, return_index=True)
+    set_surface(region, keys, width, faces[index], nnodes)
 
-def extract_surface_from_contact(region):
-    elements = region['elements']
-    dim = elements['dim']
-    surface_type = get_shape_name(dim)
-    shapes = elements[surface_type]
-    surface = []
-    for row in shapes:
-        surface.append(tuple(sorted(list(row))))
-
-    region['surface_set'] = set(surface)
+def set_surface_width(regions, nnodes):
+    '''
+      Pads the surface keys to the widest surface, when only some regions have quadrangle faces
+      Padding keeps the order of the keys
+    '''
+    width = max([x['surface_width'] for x in regions])
+    for r in regions:
+        if r['surface_width'] != width:
+            faces = get_faces_from_keys(r['surface_keys'], r['surface_width'], get_key_base(r['surface_width'], nnodes))
+            faces = get_padded_faces([(None, faces)], nnodes, width)
+            r['surface_keys'] = get_face_keys(faces, get_key_base(width, nnodes))
+            r['surface_width'] = width
 
 
 def get_shape_name(dim):
@@ -256,63 +619,95 @@ def get_shape_name(dim):
 
     raise RuntimeError("Issue getting shape name from dimension")
 
-def find_interfaces(regions):
+def find_interfaces(regions, face_index, nnodes):
+    '''
+      Every face appearing twice in the face index is on the interface of two regions
+    '''
     interfaces = []
-    rlist = [r for r in regions if r['typename']=="region"]
-    for i in range(len(rlist)-1):
-        r0 = rlist[i]['surface_set']
-        dim = rlist[i]['elements']['dim']
-        for j in range(i+1, len(rlist)):
-            r1 = rlist[j]['surface_set']
-            k = r0.intersection(r1)
-            if k:
-                print("intersection of %s and %s" % (rlist[i]['name'], rlist[j]['name']))
-
-
-                interfaces.append({
-                    'name' : rlist[i]['name'] + '_' + rlist[j]['name'],
-                    'type' : 2,
-                    'typename' : 'interface',
-                    'bulk 0' : rlist[i]['index'],
-                    'bulk 0 name' : rlist[i]['name'],
-                    'bulk 1' : rlist[j]['index'],
-                    'bulk 1 name' : rlist[j]['name'],
-                    'surface_set' : k,
-                    'elements' : {
-                        'dim' : dim - 1,
-                        get_shape_name(dim-1) : get_intersection_elements(k)
-                    }
-                })
+    keys = face_index['keys']
+    region = face_index['region']
+    shared = numpy.flatnonzero(keys[1:] == keys[:-1])
+    # the face index is stable sorted, so bulk 0 has the lower region index
+    bulk0 = region[shared]
+    bulk1 = region[shared + 1]
+    pairs = bulk0 * len(regions) + bulk1
+    # stable, so the keys stay sorted within each interface
+    order = numpy.argsort(pairs, kind='stable')
+    shared = shared[order]
+    pairs, starts, counts = numpy.unique(pairs[order], return_index=True, return_counts=True)
+    for p, start, count in zip(pairs, starts, counts):
+        r0 = regions[p // len(regions)]
+        r1 = regions[p % len(regions)]
+        k = keys[shared[start:start+count]]
+        print("intersection of %s and %s" % (r0['name'], r1['name']))
+        interfaces.append({
+            'name' : r0['name'] + '_' + r1['name'],
+            'type' : 2,
+            'typename' : 'interface',
+            'bulk 0' : r0['index'],
+            'bulk 0 name' : r0['name'],
+            'bulk 1' : r1['index'],
+            'bulk 1 name' : r1['name'],
+            'surface_keys' : k,
+            'surface_width' : face_index['width'],
+            'elements' : get_elements_from_keys(k, face_index['width'], nnodes, r0),
+        })
     return interfaces
 
-def get_elements(region):
+# devsim element type for each shape
+element_types = (
+    ('tetrahedra', 3),
+    ('triangles', 2),
+    ('edges', 1),
+    ('points', 0),
+)
+
+def is_simplex(region):
+    '''
+      devsim only has the simplex element shapes
+    '''
+    shapes = [x[0] for x in element_types]
+    return all([x[0] in shapes for x in get_element_blocks(region['elements'])])
+
+def get_element_table(region):
+    '''
+      Returns the devsim element type and the (E, k) node table of the region
+    '''
     elements = region['elements']
-    physical_index = region['physical_index']
-    out_elements = []
-    if "tetrahedra" in elements:
-        for i in elements['tetrahedra']:
-            out_elements.extend((3, physical_index, int(i[0]), int(i[1]), int(i[2]), int(i[3])))
-    elif "triangles" in elements:
-        for i in elements['triangles']:
-            out_elements.extend((2, physical_index, int(i[0]), int(i[1]), int(i[2])))
-    elif "edges" in elements:
-        for i in elements['edges']:
-            out_elements.extend((1, physical_index, int(i[0]), int(i[1])))
-    elif "points" in elements:
-        for i in elements['points']:
-            out_elements.extend((0, physical_index, int(i)))
-    return out_elements
-
-def write_region(region):
-    out_elements = get_elements(region)
+    for shape, etype in element_types:
+        if shape in elements:
+            nodes = elements[shape]
+            return etype, nodes.reshape(len(nodes), -1)
+    return 0, numpy.empty((0, 1), dtype=numpy.int64)
+
+def get_elements_size(region):
+    etype, nodes = get_element_table(region)
+    return len(nodes) * (nodes.shape[1] + 2)
+
+def get_elements(region, out=None):
+    '''
+      Returns the [type, physical, n0..nk] stream of the region elements
+      The stream is written into out when it is provided
+    '''
+    etype, nodes = get_element_table(region)
+    if out is None:
+        out = numpy.empty(get_elements_size(region), dtype=numpy.int64)
+    table = out.reshape(len(nodes), nodes.shape[1] + 2)
+    table[:, 0] = etype
+    table[:, 1] = region['physical_index']
+    table[:, 2:] = nodes
+    return out
+
+def write_region(region, out=None):
+    out_elements = get_elements(region, out)
     return {
         'name' : region['name'],
         'material' : region['material'],
         'elements' : out_elements,
     }
 
-def write_contact(contact):
-    out_elements = get_elements(contact)
+def write_contact(contact, out=None):
+    out_elements = get_elements(contact, out)
     return {
         'name' : contact['name'],
         'region' : contact['bulk 0 name'],
@@ -320,8 +715,8 @@ def write_contact(contact):
         'elements' : out_elements,
     }
 
-def write_interface(interface):
-    out_elements = get_elements(interface)
+def write_interface(interface, out=None):
+    out_elements = get_elements(interface, out)
     return {
         'name' : interface['name'],
         'region0' : interface['bulk 0 name'],
@@ -329,101 +724,168 @@ def write_interface(interface):
         'elements' : out_elements,
     }
 
-def get_coordinates(vertex,scale):
-    coordinates = []
-    # TODO: optimize
-    if len(vertex.dtype) == 2:
-        for i in vertex:
-            coordinates.extend((float(i[0])*scale, float(i[1])*scale, 0.0))
-    elif len(vertex.dtype) == 3:
-        for i in vertex:
-            coordinates.extend((float(i[0])*scale, float(i[1])*scale, float(i[2])*scale))
-    else:
+def get_coordinates(vertex, scale):
+    '''
+      Takes the structured vertex array and returns a contiguous (N, 3) array
+      z is zero filled for 2D
+    '''
+    names = vertex.dtype.names
+    if len(names) not in (2, 3):
         raise RuntimeError("Unexpected Dimension")
-    coordinates = numpy.array(coordinates)
+    coordinates = numpy.zeros((len(vertex), 3))
+    for i, n in enumerate(names):
+        coordinates[:, i] = vertex[n]
+    if scale != 1:
+        coordinates *= scale
     return coordinates
 
 def write_devsim(regions):
-    out_regions = [x for x in regions if x["type"] == 0]
-    for r in out_regions:
-        r['out_info'] = write_region(r)
-
-
-    out_contacts = [x for x in regions if x["type"] == 1]
-    for c in out_contacts:
-        c['out_info'] = write_contact(c)
-
-    out_interfaces = [x for x in regions if x["type"] == 2]
-    for i in out_interfaces:
-        i['out_info'] = write_interface(i)
-
-def read_tdr(filename, scale, drop_interfaces_at_contact):
-    f = h5py.File(filename)
-    #print(list(f.keys()))
-    collection=f['collection']
-    #print(list(collection.attrs.keys()))
-    geometry=collection['geometry_0']
-    dimension = geometry.attrs['dimension']
+    '''
+      Writes the element stream of all regions, in order, into one array
+      The out_info of each region refers to its slice of that array
+    '''
+    sizes = [get_elements_size(x) for x in regions]
+    elements = numpy.empty(sum(sizes), dtype=numpy.int64)
+    offset = 0
+    for r, size in zip(regions, sizes):
+        out = elements[offset:offset+size]
+        offset += size
+        if r["type"] == 0:
+            r['out_info'] = write_region(r, out)
+        elif r["type"] == 1:
+            r['out_info'] = write_contact(r, out)
+        elif r["type"] == 2:
+            r['out_info'] = write_interface(r, out)
+    return elements
 
+def read_topology(geometry, scale, drop_interfaces_at_contact, jobs, index_dtype=None):
+    '''
+      Returns the coordinates and the regions, with contacts and interfaces resolved
+    '''
     # this is the coordinate data
     vertex = geometry['vertex']
     if len(vertex.dtype) == 3:
         vertex=vertex['x', 'y', 'z']
     else:
         vertex=vertex['x', 'y']
-    coordinates = get_coordinates(vertex, scale)
+    with profiler.stage('read_vertex') as counts:
+        coordinates = get_coordinates(vertex, scale)
+        profiler.count(counts, nodes=len(coordinates))
 
-    regions = process_regions(geometry)
+    nnodes = len(coordinates)
+    with profiler.stage('process_regions') as counts:
+        regions = process_regions(geometry, nnodes, jobs, index_dtype)
+        profiler.count(counts, regions=len(regions))
 
-    for r in regions:
-        if r['type'] == 0:
-            extract_surface_from_volume(r)
-        else:
-            extract_surface_from_contact(r)
-
-    update_boundary_regions(regions)
+    set_surface_width(regions, nnodes)
+    with profiler.stage('get_face_index') as counts:
+        face_index = get_face_index(regions)
+        profiler.count(counts, faces=len(face_index['keys']))
+    with profiler.stage('update_boundary_regions'):
+        update_boundary_regions(regions, face_index, nnodes)
 
 
     # create interfaces
     # this is only if interfaces don't exist in regions
     if not [x for x in regions if x['type'] == 2]:
         print("no interfaces present, searching")
-        interfaces = find_interfaces(regions)
+        with profiler.stage('find_interfaces') as counts:
+            interfaces = find_interfaces(regions, face_index, nnodes)
+            profiler.count(counts, interfaces=len(interfaces), faces=sum([len(x['surface_keys']) for x in interfaces]))
         for i in interfaces:
             i['index'] = len(regions)
             regions.append(i)
 
     if drop_interfaces_at_contact:
-        remove_interfaces_at_contact(regions)
+        with profiler.stage('remove_interfaces_at_contact'):
+            remove_interfaces_at_contact(regions, nnodes)
 
     for i, j in enumerate(regions):
         j['physical_index'] = i
 
-    # process all of the elements
-    write_devsim(regions)
+    return coordinates, regions
 
-    physical_names = [x['name'] for x in regions]
+def get_geometry_names(filename):
+    '''
+      Returns the geometry_N groups of the collection, in order
+    '''
+    with h5py.File(filename, 'r') as f:
+        names = f['collection'].keys()
+        return ['geometry_%d' % i for i in sorted(int(n[9:]) for n in names if n.startswith('geometry_') and n[9:].isdigit())]
 
-    elements = []
-    for i in regions:
-        elements.extend(i['out_info']['elements'])
+def get_geometry_name(geometry):
+    '''
+      a geometry is selected by its number or its name
+    '''
+    geometry = str(geometry)
+    if geometry.isdigit():
+        return 'geometry_' + geometry
+    return geometry
 
-    return {
-        'coordinates' : coordinates,
-        'physical_names' : physical_names,
-        'elements' : elements,
-        'regions' : regions,
-        'geometry' : geometry,
-        'dimension' : dimension,
-    }
+def read_tdr(filename, scale, drop_interfaces_at_contact, jobs=1, cache_dir=None, cache_size=None, index_dtype=None, geometry_name='geometry_0'):
+    '''
+      Returns the open TdrMesh of the geometry, which closes the file when used as a context manager
+      the mesh only holds numpy arrays and records, the datasets are read from the file by their path
+    '''
+    mesh = tdr_mesh.TdrMesh(filename, get_geometry_name(geometry_name)).open()
+    try:
+        read_mesh(mesh, scale, drop_interfaces_at_contact, jobs, cache_dir, cache_size, index_dtype)
+    except BaseException:
+        mesh.close()
+        raise
+    return mesh
+
+def read_mesh(mesh, scale, drop_interfaces_at_contact, jobs, cache_dir, cache_size, index_dtype):
+    filename = mesh.filename
+    geometry_name = mesh.geometry_name
+    collection = mesh.file['collection']
+    if geometry_name not in collection:
+        raise RuntimeError("%s has no %s" % (filename, geometry_name))
+    geometry = mesh.get_geometry()
+    index_dtype = get_index_dtype(index_dtype, len(geometry['vertex']))
+
+    topology = None
+    if cache_dir:
+        with profiler.stage('load_topology_cache'):
+            cache_key = topology_cache.get_cache_key(filename, scale, drop_interfaces_at_contact, geometry_name)
+            topology = topology_cache.load_topology(cache_dir, cache_key)
+    if topology is None:
+        topology = read_topology(geometry, scale, drop_interfaces_at_contact, jobs, index_dtype)
+        if cache_dir:
+            with profiler.stage('save_topology_cache'):
+                topology_cache.save_topology(cache_dir, cache_key, *topology, cache_size=cache_size)
+    coordinates, regions = topology
+    if index_dtype is not None:
+        # the contacts and interfaces which were found, or the cached topology
+        set_index_dtype(regions, index_dtype)
+
+    # process all of the elements
+    if all([is_simplex(x) for x in regions]):
+        with profiler.stage('write_devsim_elements') as counts:
+            elements = write_devsim(regions)
+            profiler.count(counts, values=len(elements))
+    else:
+        # the other element shapes are only written by the gmsh and exodus writers
+        print("The mesh has elements other than triangles and tetrahedra, which devsim does not support")
+        elements = None
+
+    mesh.dimension = int(geometry.attrs['dimension'])
+    mesh.coordinates = coordinates
+    mesh.physical_names = [x['name'] for x in regions]
+    mesh.elements = elements
+    mesh.regions = regions
+    mesh.states = get_states(geometry)
 
 def create_devsim_mesh(mesh, data):
-    coordinates=data['coordinates']
-    regions=data['regions']
-    elements=data['elements']
-    physical_names=data['physical_names']
+    coordinates=data.coordinates
+    regions=data.regions
+    elements=data.elements
+    physical_names=data.physical_names
+    if elements is None:
+        raise RuntimeError("devsim only supports meshes of triangles and tetrahedra")
 
-    ds.create_gmsh_mesh(mesh=mesh, coordinates=coordinates, physical_names=physical_names, elements=elements)
+    # the (N, 3) array is contiguous, so this flattening is a view
+    ds.create_gmsh_mesh(mesh=mesh, coordinates=coordinates.ravel(), physical_names=physical_names, elements=elements)
     for r in regions:
         if r['typename'] == 'region':
             name = r['name']
@@ -444,85 +906,152 @@ def create_devsim_mesh(mesh, data):
             raise RuntimeError("UNEXPECTED TYPENAME")
     ds.finalize_mesh(mesh=mesh)
 
+# number of values compared at a time when looking for a constant field
+constant_chunk = 1 << 16
+
+def is_constant(values):
+    '''
+      compares the values to the first one a chunk at a time, stopping at the first chunk which differs
+    '''
+    if len(values) == 0:
+        return False
+    first = values[0]
+    for start in range(0, len(values), constant_chunk):
+        if not numpy.all(values[start:start+constant_chunk] == first):
+            return False
+    return True
+
 def create_node_solution(device, region, name, values):
+    '''
+      values is a contiguous float64 array, which devsim reads as a buffer
+    '''
     ds.node_solution(device=device, region=region, name=name)
-    if numpy.unique(values).shape[0] == 1:
-        v=values[0]
-        ds.set_node_value(device=device, region=region, name=name, value=v)
+    if is_constant(values):
+        ds.set_node_value(device=device, region=region, name=name, value=float(values[0]))
     else:
-        #v=[float(x) for x in values]
         ds.set_node_values(device=device, region=region, name=name, values=values)
 
-def load_datasets(data):
+# dataset location types
+location_vertex = 0
+location_element = 3
+
+def get_state_time(state, index):
+    '''
+      The time, or bias, of a state is taken from its attributes
+      Otherwise the state number is used
+    '''
+    for key in ('time', 'bias'):
+        if key in state.attrs:
+            return float(numpy.ravel(state.attrs[key])[0])
+    return float(index)
+
+def get_states(geometry):
+    '''
+      Returns the state_N groups of the geometry, in order
+    '''
+    indexes = sorted(int(n[6:]) for n in geometry.keys() if n.startswith('state_') and n[6:].isdigit())
+    states = []
+    for i in indexes:
+        state = geometry['state_%d' % i]
+        states.append({
+            'index' : i,
+            'name' : 'state_%d' % i,
+            'time' : get_state_time(state, i),
+        })
+    return states
+
+def load_datasets(data, names=None):
+    '''
+      Returns records of the datasets of every state, only the attributes are read
+      The values are read by their path with the get_dataset_values of the open mesh
+      names selects the datasets to load, the default is every dataset
+    '''
     print("Loading data")
+    geometry = data.get_geometry()
     datasets = []
-    state = data['geometry']['state_0']
-    for n, d in list(state.items()):
-        # skip non data sets
-        if n.find('dataset') != 0:
-            continue
-        name   = d.attrs['name'].decode('ascii')
-        region = d.attrs['region']
-        # skip non regions (interfaces, contacts)
-        region_type = data['regions'][region]['type']
-        if region_type != 0:
-            rname=data['regions'][region]['name']
-            #print(f'Skip loading data for {name} {rname} of type {region_type}')
-            continue
-        values = d['values'][()]
-        structure_type = d.attrs['structure type']
-        location_type = d.attrs['location type']
-        number_of_values = d.attrs['number of values']
-        number_of_rows = d.attrs.get('number of rows', 1)
-        # skip non scalar fields for now
-        if location_type == 0 and structure_type in (0,1,):
+    skipped = set([])
+    found = set([])
+    for s, st in enumerate(data.states):
+        state = geometry[st['name']]
+        for n, d in list(state.items()):
+            # skip non data sets
+            if n.find('dataset') != 0:
+                continue
+            name   = d.attrs['name'].decode('ascii')
+            if names is not None:
+                if name not in names:
+                    continue
+                found.add(name)
+            region = d.attrs['region']
+            # skip non regions (interfaces, contacts)
+            region_type = data.regions[region]['type']
+            if region_type != 0:
+                rname=data.regions[region]['name']
+                #print(f'Skip loading data for {name} {rname} of type {region_type}')
+                continue
+            values = d['values']
+            structure_type = d.attrs['structure type']
+            location_type = d.attrs['location type']
+            number_of_values = d.attrs['number of values']
+            number_of_rows = d.attrs.get('number of rows', 1)
+            edict = data.regions[region]['elements']
+            nnode = len(edict['coordinates'])
+            nele = get_number_of_elements(edict)
+            # skip non scalar fields for now
             # structure_type:
                 # 0 if scalar
                 # 1 if vector
-            edict = data['regions'][region]['elements']
-            nnode = len(edict['coordinates'])
+            if location_type == location_vertex and structure_type in (0,1,):
+                if nnode != (len(values) // number_of_rows):
+                    raise RuntimeError(number_of_rows)
+                load = True
+            elif location_type == location_element and structure_type in (0,1,):
+                load = nele == (len(values) // number_of_rows)
+            else:
+                load = False
 
-            if nnode != (len(values) // number_of_rows):
-                raise RuntimeError(number_of_rows)
-
-            values = numpy.transpose(values.reshape(-1, number_of_rows))
-            datasets.append(
-                {
-                    'name' : name,
-                    'region' : region,
-                    'values' : values,
-                    'dataset' : n,
-                    'nrows' : number_of_rows,
-                }
-            )
-            rname=data['regions'][region]['name']
-            edict = data['regions'][region]['elements']
-            nnode = len(edict['coordinates'])
-            sname = get_shape_name(edict['dim'])
-            nele = len(edict[sname])
-#            print(f'''Loading data for {name} {rname} {n}''')
-#            print(f'''Loading data for {name} {rname} {n}
-#    region {rname} has {nnode} nodes and {nele} {sname}
-#    {n} has {len(values)} values with {number_of_rows} rows
-#    structure {structure_type} location {location_type} type {region_type}''')
-        else:
-            rname=data['regions'][region]['name']
-            edict = data['regions'][region]['elements']
-            nnode = len(edict['coordinates'])
-            sname = get_shape_name(edict['dim'])
-            nele = len(edict[sname])
-            print(f'''Skipping data for {name} {rname} {n}
+            if load:
+                datasets.append(
+                    {
+                        'name' : name,
+                        'region' : region,
+                        'path' : '%s/%s/values' % (st['name'], n),
+                        'dataset' : n,
+                        'nrows' : number_of_rows,
+                        'structure' : structure_type,
+                        'location' : location_type,
+                        'state' : s,
+                    }
+                )
+            elif (name, region) not in skipped:
+                # only report the first state a dataset is skipped in
+                skipped.add((name, region))
+                rname=data.regions[region]['name']
+                sname = '/'.join([x[0] for x in get_element_blocks(edict)])
+                print(f'''Skipping data for {name} {rname} {n}
     region {rname} has {nnode} nodes and {nele} {sname}
     {n} has {len(values)} values
     structure {structure_type} location {location_type} type {region_type}''')
+    if names is not None:
+        for name in sorted(set(names) - found):
+            print("Dataset %s was not found" % name)
     return datasets
 
 
 def create_devsim_data(device_name, data, datasets):
+    '''
+      devsim holds one solution, so only the first state is loaded
+      only node data is loaded
+      each row of a dataset is copied once into a contiguous float64 array for devsim
+    '''
+    if len(data.states) > 1:
+        print("Loading %s of %d states into devsim" % (data.states[0]['name'], len(data.states)))
     for d in datasets:
-        r=data['regions'][d['region']]['name']
+        if d['state'] != 0 or d['location'] != location_vertex:
+            continue
+        r=data.regions[d['region']]['name']
         n=d['name']
-        v=d['values']
+        v=numpy.ascontiguousarray(data.get_dataset_values(d), dtype=numpy.float64)
         nrows = d['nrows']
 
         if nrows == 1:
@@ -530,4 +1059,3 @@ def create_devsim_data(device_name, data, datasets):
         else:
             for i in range(nrows):
                 create_node_solution(device=device_name, region=r, name=f'{n}_{i}', values=v[i,:])
-
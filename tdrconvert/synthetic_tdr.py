@@ -0,0 +1,331 @@
+#
+# Writes structured triangle and tetrahedron meshes in the tdr format, for benchmarks
+# The device is a unit square or cube split along x into bulk regions, with the contacts
+# top (on the first region), bottom (on every region, so it is split) and side (with a wrong bulk 0 reference)
+# Mixed meshes alternate quadrangles and triangles, or hexahedra and prisms, in a checkerboard along x and y
+#
+import argparse
+import h5py
+import itertools
+import numpy
+
+# tdr element type codes
+element_codes = {
+    1 : 1,
+    2 : 2,
+    3 : 5,
+}
+
+# tdr element type codes of the mixed element shapes
+quadrangle_code = 3
+prism_code = 7
+hexahedron_code = 8
+
+def get_cells(dimension, nelements):
+    '''
+      number of cells along each axis for about nelements triangles or tetrahedra
+    '''
+    # 2 triangles or 6 tetrahedra for each cell
+    ncells = nelements / (2 if dimension == 2 else 6)
+    n = max(1, int(round(ncells ** (1.0 / dimension))))
+    return (n,) * dimension
+
+def get_node_index(cells):
+    return numpy.arange(numpy.prod([x + 1 for x in cells])).reshape([x + 1 for x in cells])
+
+def get_vertex(cells):
+    dimension = len(cells)
+    axes = [numpy.linspace(0.0, 1.0, x + 1) for x in cells]
+    grid = numpy.meshgrid(*axes, indexing='ij')
+    vertex = numpy.empty(grid[0].size, dtype=[(x, numpy.float64) for x in 'xyz'[:dimension]])
+    for x, g in zip('xyz', grid):
+        vertex[x] = g.ravel()
+    return vertex
+
+def get_cell_corners(cells, xrange):
+    '''
+      returns the node of each corner of the cells between xrange[0] and xrange[1] along x
+    '''
+    dimension = len(cells)
+    index = get_node_index(cells)
+    x0, x1 = xrange
+    corners = {}
+    for offset in itertools.product((0, 1), repeat=dimension):
+        s = [slice(x0 + offset[0], x1 + offset[0])]
+        s += [slice(o, o + n) for o, n in zip(offset[1:], cells[1:])]
+        corners[offset] = index[tuple(s)]
+    return corners
+
+def get_checkerboard(shape, x0):
+    '''
+      True for the cells with an even sum of the x and y cell numbers
+    '''
+    x = numpy.arange(x0, x0 + shape[0]).reshape((-1,) + (1,) * (len(shape) - 1))
+    y = numpy.arange(shape[1]).reshape((1, -1) + (1,) * (len(shape) - 2))
+    return numpy.broadcast_to((x + y) % 2 == 0, shape)
+
+def get_volume_elements(cells, xrange):
+    '''
+      returns the elements in the cells between xrange[0] and xrange[1] along x
+      the square cells are split into 2 triangles and the cubes into 6 tetrahedra along the same diagonal
+    '''
+    dimension = len(cells)
+    corners = get_cell_corners(cells, xrange)
+    elements = []
+    # each path along the edges from the first to the last corner of the cell is an element
+    for axes in itertools.permutations(range(dimension)):
+        offset = [0] * dimension
+        nodes = [corners[tuple(offset)]]
+        for a in axes:
+            offset[a] = 1
+            nodes.append(corners[tuple(offset)])
+        elements.append(numpy.stack(nodes, axis=-1).reshape(-1, dimension + 1))
+    return numpy.concatenate(elements)
+
+def get_boundary_elements(cells, axis, position, xrange):
+    '''
+      returns the faces on the boundary where the index along axis is position
+      only the cells between xrange[0] and xrange[1] along x are included
+    '''
+    dimension = len(cells)
+    index = get_node_index(cells)
+    s = [slice(0, n + 1) for n in cells]
+    s[axis] = position
+    if axis != 0:
+        s[0] = slice(xrange[0], xrange[1] + 1)
+    plane = index[tuple(s)]
+    if dimension == 2:
+        return numpy.stack([plane[:-1], plane[1:]], axis=-1)
+    # the same diagonal as the tetrahedra
+    a = plane[:-1, :-1]
+    b = plane[1:, :-1]
+    c = plane[:-1, 1:]
+    d = plane[1:, 1:]
+    return numpy.concatenate([
+        numpy.stack([a, b, d], axis=-1).reshape(-1, 3),
+        numpy.stack([a, c, d], axis=-1).reshape(-1, 3),
+    ])
+
+def get_mixed_volume_elements(cells, xrange):
+    '''
+      returns the (code, elements, cell) blocks in the cells between xrange[0] and xrange[1] along x
+      alternate square cells are quadrangles, the others are split into 2 triangles
+      alternate cubes are hexahedra, the others are split into 2 prisms along a diagonal in x and y
+    '''
+    dimension = len(cells)
+    corners = get_cell_corners(cells, xrange)
+    shape = corners[(0,) * dimension].shape
+    cell = numpy.arange(numpy.prod(shape)).reshape(shape)
+    even = get_checkerboard(shape, xrange[0])
+    odd = ~even
+
+    def get_table(mask, *offsets):
+        return numpy.stack([corners[x][mask] for x in offsets], axis=-1)
+
+    if dimension == 2:
+        return [
+            (quadrangle_code, get_table(even, (0, 0), (1, 0), (1, 1), (0, 1)), cell[even]),
+            (element_codes[2], get_table(odd, (0, 0), (1, 0), (1, 1)), cell[odd]),
+            (element_codes[2], get_table(odd, (0, 0), (0, 1), (1, 1)), cell[odd]),
+        ]
+    return [
+        (hexahedron_code, get_table(even, (0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0), (0, 0, 1), (1, 0, 1), (1, 1, 1), (0, 1, 1)), cell[even]),
+        (prism_code, get_table(odd, (0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 0, 1), (1, 0, 1), (1, 1, 1)), cell[odd]),
+        (prism_code, get_table(odd, (0, 0, 0), (1, 1, 0), (0, 1, 0), (0, 0, 1), (1, 1, 1), (0, 1, 1)), cell[odd]),
+    ]
+
+def get_mixed_boundary_elements(cells, axis, position, xrange):
+    '''
+      returns the (code, faces, cell) blocks on the boundary where the index along axis is position
+      the faces match the elements of get_mixed_volume_elements
+    '''
+    dimension = len(cells)
+    if dimension == 2:
+        elements = get_boundary_elements(cells, axis, position, xrange)
+        return [(element_codes[1], elements, numpy.arange(len(elements)))]
+    index = get_node_index(cells)
+    s = [slice(0, n + 1) for n in cells]
+    s[axis] = position
+    if axis != 0:
+        s[0] = slice(xrange[0], xrange[1] + 1)
+    plane = index[tuple(s)]
+    a = plane[:-1, :-1]
+    b = plane[1:, :-1]
+    c = plane[:-1, 1:]
+    d = plane[1:, 1:]
+    cell = numpy.arange(a.size).reshape(a.shape)
+    if axis == 0:
+        # the faces at constant x are quadrangles for hexahedra and prisms
+        quads = numpy.ones(a.shape, dtype=bool)
+    else:
+        quads = get_checkerboard(a.shape, xrange[0])
+    triangles = ~quads
+    return [
+        (quadrangle_code, numpy.stack([a[quads], b[quads], d[quads], c[quads]], axis=-1), cell[quads]),
+        (element_codes[2], numpy.stack([a[triangles], b[triangles], d[triangles]], axis=-1), cell[triangles]),
+        (element_codes[2], numpy.stack([a[triangles], d[triangles], c[triangles]], axis=-1), cell[triangles]),
+    ]
+
+def encode_mixed_elements(blocks):
+    '''
+      the flat tdr element stream of the (code, elements, cell) blocks
+      the elements are written in the order of their cells, so the element types are interleaved
+    '''
+    blocks = [x for x in blocks if len(x[1])]
+    if len(blocks) == 1:
+        return encode_elements(blocks[0][1], code=blocks[0][0])
+    cell = numpy.concatenate([x[2] for x in blocks])
+    sizes = numpy.concatenate([numpy.full(len(x[1]), x[1].shape[1] + 1) for x in blocks])
+    order = numpy.argsort(cell, kind='stable')
+    # position of the type code of each element in block order
+    starts = numpy.empty(len(order), dtype=numpy.int64)
+    starts[order] = numpy.cumsum(sizes[order]) - sizes[order]
+    data = numpy.empty(sizes.sum(), dtype=numpy.int32)
+    offset = 0
+    for code, elements, c in blocks:
+        s = starts[offset:offset + len(elements)]
+        data[s] = code
+        data[s[:, None] + numpy.arange(1, elements.shape[1] + 1)] = elements
+        offset += len(elements)
+    return data
+
+def encode_elements(elements, dimension=None, code=None):
+    '''
+      the flat tdr element stream, with the type code before the nodes of each element
+    '''
+    data = numpy.empty((elements.shape[0], elements.shape[1] + 1), dtype=numpy.int32)
+    data[:, 0] = element_codes[dimension] if code is None else code
+    data[:, 1:] = elements
+    return data.ravel()
+
+def get_regions(cells, nregions, mixed=False):
+    '''
+      the elements of each region are (code, elements, cell) blocks
+    '''
+    dimension = len(cells)
+    if mixed:
+        get_volume = get_mixed_volume_elements
+        get_boundary = get_mixed_boundary_elements
+    else:
+        get_volume = lambda *x: [(element_codes[dimension], get_volume_elements(*x), None)]
+        get_boundary = lambda *x: [(element_codes[dimension - 1], get_boundary_elements(*x), None)]
+    nx = cells[0]
+    if nregions > nx:
+        raise RuntimeError("%d regions need at least %d cells along x" % (nregions, nregions))
+    bounds = [(i * nx) // nregions for i in range(nregions + 1)]
+    regions = []
+    for i in range(nregions):
+        regions.append({
+            'name' : 'bulk%d' % i,
+            'type' : 0,
+            'material' : 'Silicon' if i == 0 else 'Oxide',
+            'elements' : get_volume(cells, (bounds[i], bounds[i + 1])),
+        })
+    top = dimension - 1
+    regions.append({
+        'name' : 'top',
+        'type' : 1,
+        'bulk 0' : 0,
+        'elements' : get_boundary(cells, top, cells[top], (bounds[0], bounds[1])),
+    })
+    regions.append({
+        'name' : 'bottom',
+        'type' : 1,
+        'bulk 0' : 0,
+        'elements' : get_boundary(cells, top, 0, (0, nx)),
+    })
+    regions.append({
+        'name' : 'side',
+        'type' : 1,
+        'bulk 0' : 0,
+        'elements' : get_boundary(cells, 0, nx, (0, nx)),
+    })
+    return regions
+
+def write_dataset(state, index, name, region, values, location=0, nrows=None):
+    dataset = state.create_group('dataset_%d' % index)
+    dataset.attrs['name'] = numpy.bytes_(name)
+    dataset.attrs['region'] = region
+    dataset.attrs['structure type'] = 0 if nrows is None else 1
+    dataset.attrs['location type'] = location
+    dataset.attrs['number of values'] = len(values) // (nrows or 1)
+    if nrows is not None:
+        dataset.attrs['number of rows'] = nrows
+    dataset.create_dataset('values', data=values)
+
+def write_states(geometry, regions, vertex, nstates):
+    dimension = len(vertex.dtype)
+    for s in range(nstates):
+        state = geometry.create_group('state_%d' % s)
+        state.attrs['name'] = numpy.bytes_('state_%d' % s)
+        state.attrs['time'] = s * 1e-9
+        index = 0
+        for i, r in enumerate(regions):
+            nodes = r['nodes']
+            if r['type'] == 0:
+                x = vertex['x'][nodes]
+                write_dataset(state, index, 'DopingConcentration', i, 1e15 * (1 + x) * (s + 1) * (i + 1))
+                write_dataset(state, index + 1, 'Constant', i, numpy.full(len(nodes), 3.0))
+                field = numpy.stack([vertex[a][nodes] * (s + 1) for a in 'xyz'[:dimension]], axis=-1)
+                write_dataset(state, index + 2, 'ElectricField', i, field.ravel(), nrows=dimension)
+                write_dataset(state, index + 3, 'ElementData', i, numpy.arange(r['count'], dtype=numpy.float64) + s, location=3)
+                index += 4
+            else:
+                write_dataset(state, index, 'ContactData', i, numpy.ones(len(nodes)))
+                index += 1
+
+def write_synthetic_tdr(filename, cells, nregions=2, nstates=1, datasets=True, mixed=False):
+    '''
+      cells is the number of cells along each axis, its length is the dimension
+    '''
+    dimension = len(cells)
+    if dimension not in (2, 3):
+        raise RuntimeError("Expecting 2 or 3 dimensions")
+    vertex = get_vertex(cells)
+    regions = get_regions(cells, nregions, mixed)
+    with h5py.File(filename, 'w') as f:
+        geometry = f.create_group('collection').create_group('geometry_0')
+        geometry.attrs['dimension'] = dimension
+        geometry.attrs['number of regions'] = len(regions)
+        geometry.attrs['number of states'] = nstates if datasets else 0
+        geometry.create_dataset('vertex', data=vertex)
+        for i, r in enumerate(regions):
+            group = geometry.create_group('region_%d' % i)
+            group.attrs['name'] = numpy.bytes_(r['name'])
+            group.attrs['type'] = r['type']
+            group.attrs['number of parts'] = 1
+            if r['type'] == 0:
+                group.attrs['material'] = numpy.bytes_(r['material'])
+            else:
+                group.attrs['bulk 0'] = r['bulk 0']
+            group.create_dataset('elements_0', data=encode_mixed_elements(r['elements']))
+            r['nodes'] = numpy.unique(numpy.concatenate([x[1].ravel() for x in r['elements']]))
+            r['count'] = sum([len(x[1]) for x in r['elements']])
+        if datasets:
+            write_states(geometry, regions, vertex, nstates)
+    return {
+        'dimension' : dimension,
+        'nodes' : len(vertex),
+        'elements' : sum([x['count'] for x in regions if x['type'] == 0]),
+    }
+
+def run():
+    parser = argparse.ArgumentParser(description='Create a synthetic tdr file')
+    parser.add_argument('--tdr',        help='the tdr file to output', required=True)
+    parser.add_argument('--dimension',  help='2 for triangles, 3 for tetrahedra', type=int, choices=(2, 3), default=2)
+    parser.add_argument('--elements',   help='approximate number of triangles or tetrahedra', type=int, default=10000)
+    parser.add_argument('--cells',      help='comma separated number of cells along each axis, instead of --elements', required=False)
+    parser.add_argument('--regions',    help='number of bulk regions', type=int, default=2)
+    parser.add_argument('--states',     help='number of states with datasets', type=int, default=1)
+    parser.add_argument('--mixed',      help='quadrangles and triangles, or hexahedra and prisms', action='store_true')
+    args = parser.parse_args()
+
+    if args.cells:
+        cells = tuple([int(x) for x in args.cells.split(',')])
+    else:
+        cells = get_cells(args.dimension, args.elements)
+    info = write_synthetic_tdr(args.tdr, cells, nregions=args.regions, nstates=args.states, mixed=args.mixed)
+    print("Wrote %s with %d nodes and %d elements" % (args.tdr, info['nodes'], info['elements']))
+
+if __name__ == "__main__":
+    run()
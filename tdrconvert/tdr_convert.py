@@ -1,82 +1,353 @@
-import tdrconvert.read_tdr as read_tdr
-import tdrconvert.all_info as all_info
+# the readers and writers are imported when they are used, so that h5py, netCDF4 and devsim
+# are only loaded for the conversions that need them
 import tdrconvert.write_gmsh as write_gmsh
-import tdrconvert.write_tetgen as write_tetgen
-import tdrconvert.write_exodus as write_exodus
 import tdrconvert.load_devsim as ds
+import tdrconvert.profiler as profiler
 import argparse
+import copy
+import glob
+import multiprocessing
+import multiprocessing.connection
+import os
+import sys
+import time
+import traceback
 
-def tdr_convert(tdr, device_name, scale, load_datasets, drop_interfaces_at_contact):
-    data = read_tdr.read_tdr(tdr, scale, drop_interfaces_at_contact)
-    data['device_name'] = device_name
+# file name options which take a {stem}, {name}, {dir} or {geometry} template in batch mode
+output_options = ('tecplot', 'devsim', 'gmsh', 'gmsh_import', 'tetgen', 'exodus', 'vtk', 'profile')
+
+def tdr_convert(tdr, device_name, scale, load_datasets, drop_interfaces_at_contact, jobs=1, cache_dir=None, cache_size=None, index_dtype=None, geometry_name='geometry_0', dataset_names=None):
+    import tdrconvert.read_tdr as read_tdr
+    with profiler.stage('read_tdr') as counts:
+        data = read_tdr.read_tdr(tdr, scale, drop_interfaces_at_contact, jobs=jobs, cache_dir=cache_dir, cache_size=cache_size, index_dtype=index_dtype, geometry_name=geometry_name)
+        profiler.count(counts, nodes=len(data.coordinates), regions=len(data.regions))
+    data.device_name = device_name
     if load_datasets:
-        datasets=read_tdr.load_datasets(data)
-        data['datasets'] = datasets
+        try:
+            with profiler.stage('load_datasets') as counts:
+                datasets=read_tdr.load_datasets(data, dataset_names)
+                profiler.count(counts, datasets=len(datasets))
+        except BaseException:
+            data.close()
+            raise
+        data.datasets = datasets
     return data
 
 
 def create_devsim_device(device_name, data):
-    read_tdr.create_devsim_mesh(mesh='mesh', data=data)
-    ds.create_device(mesh='mesh', device=device_name)
-    if 'datasets' in data:
-        read_tdr.create_devsim_data(device_name, data, data['datasets'])
+    import tdrconvert.read_tdr as read_tdr
+    with profiler.stage('create_devsim_mesh'):
+        read_tdr.create_devsim_mesh(mesh='mesh', data=data)
+        ds.create_device(mesh='mesh', device=device_name)
+    if data.datasets is not None:
+        with profiler.stage('create_devsim_data'):
+            read_tdr.create_devsim_data(device_name, data, data.datasets)
 
 
 
 
-def run():
+def get_parser():
     parser = argparse.ArgumentParser(description='Create mesh from tdr file')
-    parser.add_argument('--tdr',           help='the tdr file to input', required=True)
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--tdr',           help='the tdr file to input')
+    inputs.add_argument('--batch',         help='manifest file with one tdr file per line, or a glob pattern, to convert many tdr files')
+    parser.add_argument('--geometry',      help='the geometry number or name to convert, or all to convert every geometry, the default is geometry_0', required=False)
     parser.add_argument('--load_datasets', help='write data sets', default=False, action='store_true')
+    parser.add_argument('--datasets',      help='comma separated names of the data sets to write, this implies --load_datasets', required=False)
     parser.add_argument('--tecplot',       help='the tecplot file to output', required=False)
     parser.add_argument('--devsim',        help='the devsim file to output', required=False)
     parser.add_argument('--gmsh',          help='the gmsh file to output', required=False)
+    parser.add_argument('--gmsh_format',   help='the gmsh file format', choices=write_gmsh.gmsh_formats, default='ascii22', required=False)
     parser.add_argument('--gmsh_import',   help='the file to write the devsim commands to recreate a new gmsh device', required=False)
     parser.add_argument('--device_name',   help='the device name', default="device", required=False)
     parser.add_argument('--scale',         help='coordinate scaling factor', default=1, type=float, required=False)
     parser.add_argument('--drop_interfaces_at_contact', help="drop interfaces from nodes at contact", default=False, action='store_true')
     parser.add_argument('--tetgen',        help='the base name for tetgen files to output', required=False)
     parser.add_argument('--exodus',        help='name of the exodus output file', required=False)
+    parser.add_argument('--exodus_compression', help='zlib level for every exodus bulk variable, 0 for none', type=int, choices=range(10), metavar='LEVEL', required=False)
+    parser.add_argument('--exodus_shuffle', help='shuffle filter for compressed exodus variables', default=True, action=argparse.BooleanOptionalAction)
+    parser.add_argument('--exodus_int64', help='write 64 bit exodus ids, the default is to use them when needed', default=None, action='store_true')
     parser.add_argument('--vtk',        help='basename for vtk output file', required=False)
     parser.add_argument('--old', help='use old method for getting data using devsim', default=False, action='store_true')
+    parser.add_argument('--cache_dir', '--cache-dir', help='directory to cache the mesh topology between runs', required=False)
+    parser.add_argument('--cache_size',    help='maximum size of the cache directory in MB', type=float, required=False)
+    parser.add_argument('--index_dtype',   help='integer type of the element node indexes, the default is the type in the tdr file', choices=('int32', 'int64'), required=False)
+    parser.add_argument('--jobs',          help='number of processes for region processing, 0 for all cores', default=1, type=int, required=False)
+    parser.add_argument('--profile',       help='the json file for a report of the time and memory of each stage', required=False)
+    parser.add_argument('--profile_stage', help='a stage to also write cProfile stats for, next to the --profile report', required=False)
+    parser.add_argument('--profile_tracemalloc', help='add tracemalloc peaks to the --profile report, this slows down the ascii writers', default=False, action='store_true')
+    parser.add_argument('--batch_jobs',    help='number of processes for --batch conversion, 0 for all cores', default=0, type=int, required=False)
+    return parser
+
+def get_geometry(args):
+    '''
+      geometry_0 is converted when no geometry is selected
+    '''
+    return args.geometry or 'geometry_0'
+
+def get_dataset_names(args):
+    '''
+      None loads every data set
+    '''
+    if not args.datasets:
+        return None
+    return set([x.strip() for x in args.datasets.split(',') if x.strip()])
+
+def convert(args):
+    '''
+      converts the single tdr file in args.tdr, with the --profile report
+    '''
+    if not args.profile:
+        return convert_tdr(args)
+    with profiler.profiling(cprofile_stage=args.profile_stage, trace_memory=args.profile_tracemalloc) as profile:
+        data = convert_tdr(args)
+    report = profiler.write_report(profile, args.profile, tdr=args.tdr, geometry=get_geometry(args))
+    profiler.print_report(report)
+    return data
+
+def convert_tdr(args):
+    '''
+      converts the single tdr file in args.tdr
+    '''
+    if args.gmsh_import and args.gmsh_format != 'ascii22':
+        raise RuntimeError('--gmsh_import requires --gmsh_format ascii22, since devsim only reads ascii gmsh files')
+
+    with tdr_convert(tdr=args.tdr, device_name=args.device_name, scale=args.scale, load_datasets=args.load_datasets or bool(args.datasets),
+                     drop_interfaces_at_contact=args.drop_interfaces_at_contact, jobs=args.jobs,
+                     cache_dir=args.cache_dir, cache_size=None if args.cache_size is None else int(args.cache_size * 1024**2),
+                     index_dtype=args.index_dtype, geometry_name=get_geometry(args), dataset_names=get_dataset_names(args)
+                     ) as data:
+        # the tdr file is closed once the outputs are written
+        use_devsim = any([args.old, args.devsim, args.tecplot, args.vtk])
+
+        if use_devsim:
+            create_devsim_device(args.device_name, data)
+
+        if args.devsim:
+            with profiler.stage('write_devsim'):
+                ds.write_devices(file=args.devsim)
+        if args.tecplot:
+            with profiler.stage('write_tecplot'):
+                ds.write_devices(file=args.tecplot, type='tecplot')
+        if args.vtk:
+            with profiler.stage('write_vtk'):
+                ds.write_devices(file=args.vtk, type='vtk')
+
+        if args.gmsh or args.tetgen or args.exodus:
+            import tdrconvert.all_info as all_info
+            with profiler.stage('get_info'):
+                if args.old:
+                    info = all_info.get_all_info(args.device_name)
+                else:
+                    info = all_info.get_info_from_tdr_data(args.device_name, data)
+
+        if args.gmsh:
+            with profiler.stage('write_gmsh'):
+                write_gmsh.write_gmsh(filename=args.gmsh, all_info=info, gmsh_format=args.gmsh_format)
+            if args.gmsh_import:
+                write_gmsh.write_gmsh_import(args.gmsh, args.gmsh_import, info['device_info'])
+        if args.tetgen:
+            import tdrconvert.write_tetgen as write_tetgen
+            with profiler.stage('write_tetgen'):
+                write_tetgen.write_tetgen(basename=args.tetgen, all_info=info)
+        if args.exodus:
+            if args.load_datasets or args.datasets:
+                if args.old:
+                    raise RuntimeError('--load_datasets is not currently supported with --old option when writing exodus format')
+                #else:
+                #    raise RuntimeError('FINISH HERE')
+            import tdrconvert.write_exodus as write_exodus
+            with profiler.stage('write_exodus'):
+                write_exodus.write_exodus(filename=args.exodus, all_info=info, data=data,
+                                          compression=args.exodus_compression, shuffle=args.exodus_shuffle, int64=args.exodus_int64)
+
+    return data
 
-    args = parser.parse_args()
-
-    data=tdr_convert(tdr=args.tdr, device_name=args.device_name, scale=args.scale, load_datasets=args.load_datasets,
-                     drop_interfaces_at_contact=args.drop_interfaces_at_contact
-                     )
-
-    use_devsim = any([args.old, args.devsim, args.tecplot, args.vtk])
-
-    if use_devsim:
-        create_devsim_device(args.device_name, data)
-
-    if args.devsim:
-        ds.write_devices(file=args.devsim)
-    if args.tecplot:
-        ds.write_devices(file=args.tecplot, type='tecplot')
-    if args.vtk:
-        ds.write_devices(file=args.tecplot, type='vtk')
-
-    if args.gmsh or args.tetgen or args.exodus:
-        if args.old:
-            info = all_info.get_all_info(args.device_name)
-        else:
-            info = all_info.get_info_from_tdr_data(args.device_name, data)
-
-    if args.gmsh:
-        write_gmsh.write_gmsh(filename=args.gmsh, all_info=info)
-        if args.gmsh_import:
-            write_gmsh.write_gmsh_import(args.gmsh, args.gmsh_import, info['device_info'])
-    if args.tetgen:
-        write_tetgen.write_tetgen(basename=args.tetgen, all_info=info)
-    if args.exodus:
-        if args.load_datasets:
-            if args.old:
-                raise RuntimeError('--load_datasets is not currently supported with --old option when writing exodus format')
-            #else:
-            #    raise RuntimeError('FINISH HERE')
-        write_exodus.write_exodus(filename=args.exodus, all_info=info, data=data)
+def reset_devsim():
+    '''
+      removes the devices and meshes, so the next file in the process starts clean
+    '''
+    for d in ds.get_device_list():
+        ds.delete_device(device=d)
+    for m in ds.get_mesh_list():
+        ds.delete_mesh(mesh=m)
+
+def convert_file(args):
+    '''
+      converts one file of a batch, returning the error instead of raising it
+    '''
+    result = {
+        'tdr' : args.tdr,
+        'geometry' : args.geometry,
+        'size' : 0,
+        'error' : None,
+    }
+    start = time.perf_counter()
+    try:
+        result['size'] = os.path.getsize(args.tdr)
+        convert(args)
+    except Exception:
+        result['error'] = traceback.format_exc()
+    if any([args.old, args.devsim, args.tecplot, args.vtk]):
+        # a devsim which can't be reset fails this file, and the next file reports its own error
+        try:
+            reset_devsim()
+        except Exception:
+            result['error'] = (result['error'] or '') + traceback.format_exc()
+    result['time'] = time.perf_counter() - start
+    return result
+
+def get_batch_files(batch):
+    '''
+      a manifest has one file per line, blank lines and lines starting with # are skipped
+    '''
+    if os.path.isfile(batch):
+        with open(batch) as ifh:
+            files = [x.strip() for x in ifh]
+        return [x for x in files if x and not x.startswith('#')]
+    return sorted(glob.glob(batch))
+
+def get_batch_geometries(args, tdr):
+    '''
+      every geometry of the file with --geometry all
+      a file which can't be read is left to fail in its conversion
+    '''
+    if args.geometry != 'all':
+        return [args.geometry]
+    import tdrconvert.read_tdr as read_tdr
+    try:
+        return read_tdr.get_geometry_names(tdr)
+    except Exception:
+        return [None]
+
+def get_batch_args(args, tdr, geometry=None, ngeometries=1):
+    '''
+      fills in {stem}, {name}, {dir} and {geometry} of every output file name
+      when a file has more than one geometry, names without {geometry} get it before their extension
+    '''
+    fields = {
+        'stem' : os.path.splitext(os.path.basename(tdr))[0],
+        'name' : os.path.basename(tdr),
+        'dir' : os.path.dirname(tdr) or '.',
+        'geometry' : geometry or 'geometry_0',
+    }
+    file_args = copy.copy(args)
+    file_args.tdr = tdr
+    file_args.batch = None
+    file_args.geometry = geometry
+    for o in output_options:
+        value = getattr(args, o)
+        if value:
+            if ngeometries > 1 and '{geometry}' not in value:
+                base, extension = os.path.splitext(value)
+                value = base + '_{geometry}' + extension
+            value = value.format(**fields)
+            if os.path.dirname(value):
+                os.makedirs(os.path.dirname(value), exist_ok=True)
+            setattr(file_args, o, value)
+    return file_args
+
+def convert_in_child(connection, args):
+    connection.send(convert_file(args))
+    connection.close()
+
+def convert_in_processes(batch_args, jobs):
+    '''
+      converts each file in its own child process, with up to jobs at a time, and yields the results as they finish
+      a process which dies, such as from running out of memory, only fails its own file
+    '''
+    context = multiprocessing.get_context()
+    pending = list(batch_args)
+    running = {}
+    while pending or running:
+        while pending and len(running) < jobs:
+            a = pending.pop(0)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=convert_in_child, args=(sender, a))
+            process.start()
+            sender.close()
+            running[receiver] = (process, a, time.perf_counter())
+        for receiver in multiprocessing.connection.wait(list(running)):
+            process, a, start = running.pop(receiver)
+            try:
+                result = receiver.recv()
+            except EOFError:
+                process.join()
+                result = {
+                    'tdr' : a.tdr,
+                    'geometry' : a.geometry,
+                    'size' : 0,
+                    'time' : time.perf_counter() - start,
+                    'error' : 'the conversion process exited with code %s\n' % process.exitcode,
+                }
+            receiver.close()
+            process.join()
+            yield result
+
+def convert_batch(args):
+    '''
+      converts the files of --batch, or every geometry of --tdr with --geometry all
+    '''
+    if args.batch:
+        files = get_batch_files(args.batch)
+        if not files:
+            raise RuntimeError('no tdr files found for --batch %s' % args.batch)
+    else:
+        files = [args.tdr]
+    for o in output_options:
+        value = getattr(args, o)
+        if value and len(files) > 1 and value == value.format(stem='', name='', dir='', geometry=''):
+            raise RuntimeError('--%s %s must contain {stem}, {name} or {dir} to write a file for each tdr file' % (o, value))
+
+    batch_args = []
+    for x in files:
+        geometries = get_batch_geometries(args, x)
+        batch_args.extend([get_batch_args(args, x, g, len(geometries)) for g in geometries])
+    import tdrconvert.read_tdr as read_tdr
+    jobs = min(read_tdr.get_jobs(args.batch_jobs), len(batch_args))
+    if len(batch_args) != len(files):
+        print("Converting %d geometries of %d files with %d processes" % (len(batch_args), len(files), jobs))
+    else:
+        print("Converting %d files with %d processes" % (len(files), jobs))
+
+    start = time.perf_counter()
+    results = []
+    if jobs == 1:
+        for a in batch_args:
+            results.append(convert_file(a))
+            print_batch_result(results[-1], len(results), len(batch_args))
+    else:
+        for result in convert_in_processes(batch_args, jobs):
+            results.append(result)
+            print_batch_result(result, len(results), len(batch_args))
+    elapsed = time.perf_counter() - start
+
+    failures = [x for x in results if x['error']]
+    # a file with many geometries is counted once
+    size = sum(dict([(x['tdr'], x['size']) for x in results if not x['error']]).values()) / 1024**2
+    unit = 'files' if len(batch_args) == len(files) else 'geometries'
+    print("Converted %d of %d %s in %g s, %g %s/s, %g MB/s" % (
+        len(results) - len(failures), len(batch_args), unit, elapsed, (len(results) - len(failures)) / elapsed, unit, size / elapsed))
+    for x in failures:
+        print("FAILED %s\n%s" % (get_result_name(x), x['error']))
+    return failures
+
+def get_result_name(result):
+    if result.get('geometry'):
+        return '%s %s' % (result['tdr'], result['geometry'])
+    return result['tdr']
+
+def print_batch_result(result, index, total):
+    status = 'FAILED' if result['error'] else 'done'
+    print("[%d/%d] %s %s in %g s" % (index, total, status, get_result_name(result), result['time']))
+
+def run():
+    args = get_parser().parse_args()
+    if args.batch or args.geometry == 'all':
+        if convert_batch(args):
+            sys.exit(1)
+    else:
+        convert(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,89 @@
+#
+# In memory mesh of one geometry of a tdr file
+# The mesh owns the open h5py file in its file slot, and get_geometry returns a group of it,
+# its coordinates, regions, states and datasets hold only numpy arrays and hdf5 paths,
+# so closing it releases the file handle and its chunk caches
+#
+import h5py
+
+class TdrMesh:
+    '''
+      coordinates is the (N, 3) array of node coordinates
+      regions are the region, contact and interface records, with the connectivity in 'elements'
+      elements is the devsim element stream, or None when devsim does not support the element shapes
+      states and datasets are records of the state_N groups and their datasets,
+      the values of a dataset are read by its path with get_dataset_values while the file is open
+    '''
+    __slots__ = (
+        'filename',
+        'geometry_name',
+        'device_name',
+        'dimension',
+        'coordinates',
+        'physical_names',
+        'elements',
+        'regions',
+        'states',
+        'datasets',
+        'file',
+    )
+
+    def __init__(self, filename, geometry_name='geometry_0'):
+        self.filename = filename
+        self.geometry_name = geometry_name
+        self.device_name = None
+        self.dimension = None
+        self.coordinates = None
+        self.physical_names = None
+        self.elements = None
+        self.regions = None
+        self.states = None
+        self.datasets = None
+        self.file = None
+
+    def open(self):
+        if self.file is None:
+            self.file = h5py.File(self.filename, 'r')
+        return self
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_geometry(self):
+        '''
+          the hdf5 group of the geometry, which is only valid until the file is closed
+        '''
+        if self.file is None:
+            raise RuntimeError("%s is not open" % self.filename)
+        return self.file['collection'][self.geometry_name]
+
+    def get_dataset_values(self, dataset):
+        '''
+          Reads the values of a dataset record from load_datasets
+          Returns a (nrows, nvalues) array, which is not kept by the mesh
+        '''
+        values = self.get_geometry()[dataset['path']][()]
+        return values.reshape(-1, dataset['nrows']).transpose()
+
+    def get_records(self, typename):
+        return [x for x in self.regions if x['typename'] == typename]
+
+    @property
+    def bulk_regions(self):
+        return self.get_records('region')
+
+    @property
+    def contacts(self):
+        return self.get_records('contact')
+
+    @property
+    def interfaces(self):
+        return self.get_records('interface')
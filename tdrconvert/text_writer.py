@@ -0,0 +1,91 @@
+import numpy as np
+
+# number of rows formatted into one buffer
+chunk_size = 32768
+
+def get_integer_pieces(row_format, table):
+    '''
+      the literal text around each field, when every field is a %d of a non negative integer column
+      otherwise None, and the rows are formatted with %
+    '''
+    if not np.issubdtype(table.dtype, np.integer):
+        return None
+    pieces = row_format.split('%d')
+    if len(pieces) != table.shape[1] + 1 or any(['%' in x for x in pieces]):
+        return None
+    if table.size and table.min() < 0:
+        return None
+    return [x.encode('ascii') for x in pieces]
+
+# the 4 digits of 0 to 9999 with leading zeros, each as the uint32 of its 4 bytes
+digit_groups = np.frombuffer(b''.join([b'%04d' % i for i in range(10000)]), dtype=np.uint32)
+# the bytes of the 4 digits of 0 to 9999 which are not leading zeros
+# the last group of a value keeps its last digit for 0, and a group after a nonzero group keeps every digit
+group_masks = np.frombuffer(b''.join([bytes([k >= 4 - len(str(i).lstrip('0')) for k in range(4)]) for i in range(10000)]), dtype=np.uint32)
+last_group_masks = np.frombuffer(b''.join([bytes([k >= 4 - len(str(i)) for k in range(4)]) for i in range(10000)]), dtype=np.uint32)
+all_digits = np.frombuffer(bytes([1, 1, 1, 1]), dtype=np.uint32)[0]
+
+def format_integer_rows(table, pieces):
+    '''
+      formats the rows into a byte table, with each value zero padded to whole groups of 4 digits
+      the leading zeros of each value are then masked out, leaving the same text as %d
+      the digits and the mask of a group are written as one uint32
+    '''
+    nrows = len(table)
+    largest = table.max(axis=0) if nrows else np.zeros(table.shape[1], dtype=np.int64)
+    ngroups = [(len(str(int(x))) + 3) // 4 for x in largest]
+    width = sum([len(x) for x in pieces]) + 4 * sum(ngroups)
+    text = np.empty((nrows, width), dtype=np.uint8)
+    keep = np.ones((nrows, width), dtype=bool)
+    position = 0
+    for c, n in enumerate(ngroups):
+        piece = pieces[c]
+        text[:, position:position+len(piece)] = np.frombuffer(piece, dtype=np.uint8)
+        position += len(piece)
+        values = table[:, c].astype(np.int64)
+        # from the last group to the first
+        masks = last_group_masks
+        for g in range(n - 1, -1, -1):
+            values, group = np.divmod(values, 10000)
+            start = position + 4 * g
+            text[:, start:start+4].view(np.uint32)[:, 0] = digit_groups.take(group)
+            keep[:, start:start+4].view(np.uint32)[:, 0] = np.where(values > 0, all_digits, masks.take(group))
+            masks = group_masks
+        position += 4 * n
+    text[:, position:] = np.frombuffer(pieces[-1], dtype=np.uint8)
+    return text[keep].tobytes().decode('ascii')
+
+def add_offset(values, offset):
+    '''
+      integers are offset as int64, so that the largest int32 node index does not wrap
+    '''
+    if not offset:
+        return values
+    if np.issubdtype(values.dtype, np.integer):
+        return values.astype(np.int64) + offset
+    return values + offset
+
+def write_rows(ofh, row_format, columns, index_start=None, offset=0, chunk_size=chunk_size):
+    '''
+      Writes one line per row, formatted with row_format, in chunks of rows
+      columns is a list of 1D or 2D arrays with the same number of rows
+      when index_start is given, an index column counting from it is written first
+      offset is added to the values of the columns, such as 1 for 1 based node numbers
+      rows of only integer %d fields are formatted with numpy, without a python object per value
+      otherwise integers and floats are formatted as floats with %, so %d is exact up to 2**53
+    '''
+    columns = [np.asarray(x) for x in columns]
+    columns = [x.reshape(len(x), -1) for x in columns]
+    nrows = len(columns[0]) if columns else 0
+    for start in range(0, nrows, chunk_size):
+        end = min(start + chunk_size, nrows)
+        table = [add_offset(x[start:end], offset) for x in columns]
+        if index_start is not None:
+            table.insert(0, np.arange(index_start + start, index_start + end).reshape(-1, 1))
+        table = np.hstack(table)
+        pieces = get_integer_pieces(row_format, table)
+        if pieces is not None:
+            ofh.write(format_integer_rows(table, pieces))
+        else:
+            ofh.write((row_format * (end - start)) % tuple(table.ravel().tolist()))
+    return nrows
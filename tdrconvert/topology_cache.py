@@ -0,0 +1,143 @@
+#
+# On disk cache of the resolved topology of a tdr file
+# Each entry is an npz file named by a hash of the file content and the conversion options
+# Other processes may add and remove entries at the same time, so an entry which goes missing
+# or can't be read is a cache miss, and an entry which can't be written is skipped
+#
+import hashlib
+import json
+import numpy
+import os
+import tempfile
+import zipfile
+
+# change when the cached topology changes
+cache_version = 1
+
+# default size limit of the cache directory
+default_cache_size = 10 * 1024**3
+
+# region entries which are not saved
+skipped_fields = ('surface_keys', 'quad_keys', 'quads', 'out_info', 'elements')
+
+def get_cache_key(filename, scale, drop_interfaces_at_contact, geometry_name='geometry_0'):
+    '''
+      hash of the file content and the options that change the topology
+    '''
+    h = hashlib.sha256()
+    with open(filename, 'rb') as ifh:
+        for block in iter(lambda: ifh.read(1 << 20), b''):
+            h.update(block)
+    h.update(json.dumps([cache_version, float(scale), bool(drop_interfaces_at_contact), geometry_name]).encode('ascii'))
+    return h.hexdigest()
+
+def get_cache_filename(cache_dir, key):
+    return os.path.join(cache_dir, key + '.npz')
+
+def to_json(value):
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+def save_topology(cache_dir, key, coordinates, regions, cache_size=None):
+    '''
+      writes the coordinates and the region elements and attributes
+    '''
+    try:
+        write_topology(cache_dir, key, coordinates, regions)
+    except OSError as e:
+        print("Could not save topology to cache %s: %s" % (get_cache_filename(cache_dir, key), e))
+        return
+    evict(cache_dir, cache_size)
+
+def write_topology(cache_dir, key, coordinates, regions):
+    os.makedirs(cache_dir, exist_ok=True)
+    arrays = {'coordinates' : coordinates}
+    metadata = []
+    for i, r in enumerate(regions):
+        metadata.append({
+            'fields' : {k : to_json(v) for k, v in r.items() if k not in skipped_fields},
+            'dim' : int(r['elements']['dim']),
+            'elements' : [k for k in r['elements'].keys() if k != 'dim'],
+        })
+        for k, v in r['elements'].items():
+            if k != 'dim':
+                arrays['region_%d_%s' % (i, k)] = v
+    arrays['metadata'] = numpy.frombuffer(json.dumps(metadata).encode('utf-8'), dtype=numpy.uint8)
+
+    # written to a temporary file first, so readers never see a partial entry
+    fd, tmpname = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as ofh:
+            numpy.savez(ofh, **arrays)
+        os.replace(tmpname, get_cache_filename(cache_dir, key))
+    except BaseException:
+        remove_entry(tmpname)
+        raise
+    print("Saved topology to cache %s" % get_cache_filename(cache_dir, key))
+
+def load_topology(cache_dir, key):
+    '''
+      returns the coordinates and regions, or None if the key is not in the cache
+    '''
+    filename = get_cache_filename(cache_dir, key)
+    try:
+        with numpy.load(filename, allow_pickle=False) as npz:
+            metadata = json.loads(npz['metadata'].tobytes().decode('utf-8'))
+            coordinates = npz['coordinates']
+            regions = []
+            for i, m in enumerate(metadata):
+                r = dict(m['fields'])
+                r['elements'] = {'dim' : m['dim']}
+                for k in m['elements']:
+                    r['elements'][k] = npz['region_%d_%s' % (i, k)]
+                regions.append(r)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        print("Could not load topology from cache %s: %s" % (filename, e))
+        return None
+    # the access time for lru eviction, the entry may have been evicted by now
+    try:
+        os.utime(filename)
+    except OSError:
+        pass
+    print("Loaded topology from cache %s" % filename)
+    return coordinates, regions
+
+def evict(cache_dir, cache_size=None):
+    '''
+      removes the least recently used entries until the cache fits in cache_size bytes
+    '''
+    if cache_size is None:
+        cache_size = default_cache_size
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+    entries = []
+    for n in names:
+        if n.endswith('.npz'):
+            try:
+                st = os.stat(os.path.join(cache_dir, n))
+            except OSError:
+                # removed by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, n))
+    entries.sort()
+    total = sum([x[1] for x in entries])
+    for mtime, size, n in entries:
+        if total <= cache_size:
+            break
+        print("Removing %s from cache" % n)
+        remove_entry(os.path.join(cache_dir, n))
+        total -= size
+
+def remove_entry(filename):
+    '''
+      another process may have removed the file already
+    '''
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
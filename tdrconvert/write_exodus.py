@@ -1,8 +1,82 @@
 from netCDF4 import Dataset,stringtoarr
 import numpy as np
+from . import read_tdr
 
-def write(rootgrp, all_info):
+# number of values in one chunk of a bulk variable
+chunk_values = 1 << 20
+
+# EX_MAPS_INT64_DB | EX_IDS_INT64_DB | EX_BULK_INT64_DB
+int64_all = 0x0200 | 0x0400 | 0x0800
+
+def get_options(all_info, compression=None, shuffle=True, int64=None):
+    '''
+      int64 of None switches to 64 bit ids when the node or element counts need it
+      compression of None only compresses the coordinates, 0 disables compression,
+      otherwise it is the zlib level for every bulk variable
+    '''
+    if int64 is None:
+        num_nodes = len(all_info['coordinates'])
+        num_elem = sum([len(x[2]) for x in get_element_blocks(all_info['region_info'])])
+        int64 = max(num_nodes, num_elem) > np.iinfo(np.int32).max
+    if int64:
+        print("writing exodus file with 64 bit integers")
+
+    coordinates = {}
+    bulk = {}
+    if compression is None:
+        coordinates = {'compression' : 'zlib', 'shuffle' : shuffle}
+    elif compression > 0:
+        bulk = {'compression' : 'zlib', 'complevel' : compression, 'shuffle' : shuffle}
+        coordinates = bulk
+
+    return {
+        'int64' : int64,
+        'int' : 'i8' if int64 else 'i4',
+        'coordinates' : coordinates,
+        'bulk' : bulk,
+    }
+
+# exodus element type and the local nodes of each side of every element shape
+# the tdr node order of each shape is the exodus node order
+element_types = {
+    'triangles' : ('TRI3', ((0, 1), (1, 2), (2, 0))),
+    'quadrangles' : ('QUAD4', ((0, 1), (1, 2), (2, 3), (3, 0))),
+    'tetrahedra' : ('TETRA', ((0, 1, 3), (1, 2, 3), (0, 2, 3), (0, 1, 2))),
+    'pyramids' : ('PYRAMID', ((0, 1, 4), (1, 2, 4), (2, 3, 4), (3, 0, 4), (0, 3, 2, 1))),
+    'prisms' : ('WEDGE', ((0, 1, 4, 3), (1, 2, 5, 4), (0, 3, 5, 2), (0, 2, 1), (3, 4, 5))),
+    'hexahedra' : ('HEX8', ((0, 1, 5, 4), (1, 2, 6, 5), (2, 3, 7, 6), (0, 4, 7, 3), (0, 3, 2, 1), (4, 5, 6, 7))),
+}
+
+def get_element_blocks(region_info):
+    '''
+      each element shape of a region is an element block
+      returns the (region name, shape, elements, first element in the region) of each block
+    '''
+    blocks = []
+    for name, info in region_info.items():
+        start = 0
+        for shape, elements in info.blocks:
+            blocks.append((name, shape, np.asarray(elements), start))
+            start += len(elements)
+    return blocks
+
+def get_block_name(name, shape, region_info):
+    '''
+      the block of a region with one element shape has the name of the region
+    '''
+    if len(region_info[name].blocks) == 1:
+        return name
+    return name + '_' + shape
+
+def get_chunks(rows, columns=1):
+    '''
+      chunks of whole rows, with about chunk_values values
+    '''
+    return (max(1, min(rows, chunk_values // columns)), columns)
+
+def write(rootgrp, all_info, options):
     print("writing exodus file")
+    int_type = options['int']
     coordinates = all_info['coordinates']
     region_info = all_info['region_info']
     boundary_info = all_info['boundary_info']
@@ -13,7 +87,7 @@ def write(rootgrp, all_info):
     rootgrp.setncattr('floating_point_word_size', np.array(8, 'i4'))
     rootgrp.setncattr('file_size', np.array(1, 'i4'))
     rootgrp.setncattr('maximum_name_length', np.array(32, 'i4'))
-    rootgrp.setncattr('int64_status', np.array(0, 'i4'))
+    rootgrp.setncattr('int64_status', np.array(int64_all if options['int64'] else 0, 'i4'))
     rootgrp.setncattr('title', 'tdrconvert')
     #
     # dimensions
@@ -26,16 +100,15 @@ def write(rootgrp, all_info):
     rootgrp.createDimension('num_dim', num_dim)
     rootgrp.createDimension('num_nodes', len(coordinates))
 
-    elementcounts = [len(x.elements) for x in region_info.values()]
-    nod_per_el = [len(x.elements[0]) for x in region_info.values()]
+    blocks = get_element_blocks(region_info)
+    elementcounts = [len(x[2]) for x in blocks]
+    nod_per_el = [x[2].shape[1] for x in blocks]
     rootgrp.createDimension('num_elem', sum(elementcounts))
     num_el_blk = len(elementcounts)
     rootgrp.createDimension('num_el_blk', num_el_blk)
-#TODO: num_side_sets
     for n, c in enumerate(elementcounts):
        rootgrp.createDimension(f'num_el_in_blk{n+1}', c)
        rootgrp.createDimension(f'num_nod_per_el{n+1}', nod_per_el[n])
-#side set stuff, include distribution factors
     rootgrp.createDimension('four', 4)
     len_string = 33
     rootgrp.createDimension('len_string', len_string)
@@ -56,7 +129,7 @@ def write(rootgrp, all_info):
     x=rootgrp.createVariable('eb_status', 'i4', ('num_el_blk',))
     x[:] = [1]*num_el_blk
 
-    ebp=rootgrp.createVariable('eb_prop1', 'i4', ('num_el_blk',))
+    ebp=rootgrp.createVariable('eb_prop1', int_type, ('num_el_blk',))
     # https://unidata.github.io/netcdf4-python/#attributes-in-a-netcdf-file
     # name is reserved in python
     ebp.setncattr('name', 'ID')
@@ -71,16 +144,16 @@ def write(rootgrp, all_info):
 
     for i, n in enumerate(('coordx', 'coordy', 'coordz')):
         if i < num_dim:
-            x = rootgrp.createVariable(n, 'f8', ('num_nodes',), compression='zlib')
-            x[0:] = np.array([y[i] for y in coordinates])
+            x = rootgrp.createVariable(n, 'f8', ('num_nodes',), chunksizes=get_chunks(len(coordinates))[:1], **options['coordinates'])
+            x[0:] = coordinates[:, i]
 
     #
     # block names
     #
 
     ebn=rootgrp.createVariable('eb_names', 'S1', ('num_el_blk', 'len_name'), fill_value='')
-    for i, x in enumerate(region_info.keys()):
-        ebn[i] = stringtoarr(x, len_name)
+    for i, (name, shape, elements, start) in enumerate(blocks):
+        ebn[i] = stringtoarr(get_block_name(name, shape, region_info), len_name)
 
     cn=rootgrp.createVariable('coor_names', 'S1', ('num_dim', 'len_name'), fill_value='')
     for i, x in enumerate(('x', 'y', 'z')):
@@ -90,32 +163,149 @@ def write(rootgrp, all_info):
     #
     # connection data
     #
-    for i,x in enumerate(region_info.values()):
+    for i, (name, shape, elements, start) in enumerate(blocks):
         npe = nod_per_el[i]
-        if npe == 3:
-            sname = 'TRI3'
-        elif npe == 4:
-            sname = 'TETRA'
+        sname = element_types[shape][0]
         s = str(i+1)
-        cn=rootgrp.createVariable(f'connect{s}', 'i4', (f'num_el_in_blk{s}', f'num_nod_per_el{s}'))
+        cn=rootgrp.createVariable(f'connect{s}', int_type, (f'num_el_in_blk{s}', f'num_nod_per_el{s}'),
+                                  chunksizes=get_chunks(elementcounts[i], npe), **options['bulk'])
         cn.elem_type = sname
-        cn[:,:] = x.elements
+        write_node_numbers(cn, elements)
     #
-    # need to handle contacts as side sets
+    # contacts and interfaces as side sets
     #
+    write_side_sets(rootgrp, all_info, options)
+
+def write_node_numbers(variable, elements):
+    '''
+      writes the 0 based elements as 1 based node numbers, one slice at a time
+      the numbers are made in int64, so that the largest int32 node index does not wrap
+    '''
+    elements = np.asarray(elements)
+    rows = max(1, chunk_values // max(1, elements.shape[1]))
+    for start in range(0, len(elements), rows):
+        variable[start:start+rows] = elements[start:start+rows].astype(np.int64) + 1
+
+def get_side_table(blocks, element_offset, num_nodes):
+    '''
+      Takes the (shape, elements) blocks of a region, numbered from element_offset + 1
+      Returns the sorted face keys of every element side,
+      with the exodus element number and side number of each key
+      sides with fewer nodes than the widest side are padded, as in read_tdr
+    '''
+    width = max([len(x) for shape, elements in blocks for x in element_types[shape][1]])
+    base = read_tdr.get_key_base(width, num_nodes)
+    keys = []
+    element_numbers = []
+    side_numbers = []
+    for shape, elements in blocks:
+        elements = np.asarray(elements)
+        sides = element_types[shape][1]
+        for n in sorted(set([len(x) for x in sides])):
+            numbers = [i for i, x in enumerate(sides) if len(x) == n]
+            faces = np.sort(elements[:, [sides[i] for i in numbers]], axis=2).reshape(-1, n)
+            faces = read_tdr.get_padded_faces([(None, faces)], num_nodes, width)
+            keys.append(read_tdr.get_face_keys(faces, base))
+            element_numbers.append(np.repeat(np.arange(element_offset + 1, element_offset + len(elements) + 1), len(numbers)))
+            side_numbers.append(np.tile(np.array(numbers) + 1, len(elements)))
+        element_offset += len(elements)
+    keys = np.concatenate(keys)
+    order = np.argsort(keys, kind='stable')
+    return {
+        'width' : width,
+        'keys' : keys[order],
+        'elements' : np.concatenate(element_numbers)[order],
+        'sides' : np.concatenate(side_numbers)[order],
+    }
+
+def get_side_set(side_table, blocks, num_nodes):
+    '''
+      Finds the element and side of each face of the (shape, faces) blocks
+      Faces not on the region are reported and dropped
+    '''
+    width = side_table['width']
+    faces = read_tdr.get_padded_faces([(shape, np.asarray(x)) for shape, x in blocks], num_nodes, width)
+    keys = read_tdr.get_face_keys(np.sort(faces, axis=1), read_tdr.get_key_base(width, num_nodes))
+    table_keys = side_table['keys']
+    index = np.searchsorted(table_keys, keys)
+    index[index == len(table_keys)] = 0
+    found = table_keys[index] == keys if len(table_keys) else np.zeros(len(keys), dtype=bool)
+    index = index[found]
+    return side_table['elements'][index], side_table['sides'][index], len(keys) - len(index)
+
+def write_side_sets(rootgrp, all_info, options):
+    region_info = all_info['region_info']
+    boundary_info = all_info['boundary_info']
+    device_info = all_info['device_info']
+    num_nodes = rootgrp.dimensions['num_nodes'].size
+
+    # each boundary is a side set on the first region it is attached to
+    attached = {}
+    for name, c in device_info['contacts'].items():
+        attached[name] = c['region']
+    for name, i in device_info['interfaces'].items():
+        attached[name] = i['region0']
+
+    element_offsets = {}
+    offset = 0
+    for name, x in region_info.items():
+        element_offsets[name] = offset
+        offset += sum([len(e) for s, e in x.blocks])
+
+    side_sets = []
+    side_tables = {}
+    for name, info in boundary_info.items():
+        region = attached[name]
+        if region not in side_tables:
+            side_tables[region] = get_side_table(region_info[region].blocks, element_offsets[region], num_nodes)
+        elements, sides, missing = get_side_set(side_tables[region], info.blocks, num_nodes)
+        if missing:
+            print(f'{missing} elements of {name} are not on region {region} and are not in its side set')
+        side_sets.append((name, elements, sides))
+
+    num_side_sets = len(side_sets)
+    if num_side_sets == 0:
+        return
+    len_name = rootgrp.dimensions['len_name'].size
+    rootgrp.createDimension('num_side_sets', num_side_sets)
+
+    x=rootgrp.createVariable('ss_status', 'i4', ('num_side_sets',))
+    x[:] = [1]*num_side_sets
+
+    ssp=rootgrp.createVariable('ss_prop1', options['int'], ('num_side_sets',))
+    ssp.setncattr('name', 'ID')
+    for i in range(num_side_sets):
+        ssp[i]=i+1
+
+    ssn=rootgrp.createVariable('ss_names', 'S1', ('num_side_sets', 'len_name'), fill_value='')
+    for i, (name, elements, sides) in enumerate(side_sets):
+        ssn[i] = stringtoarr(name, len_name)
+
+    for i, (name, elements, sides) in enumerate(side_sets):
+        s = str(i+1)
+        rootgrp.createDimension(f'num_side_ss{s}', len(elements))
+        chunks = get_chunks(len(elements))[:1]
+        x = rootgrp.createVariable(f'elem_ss{s}', options['int'], (f'num_side_ss{s}',), chunksizes=chunks, **options['bulk'])
+        x[:] = elements
+        x = rootgrp.createVariable(f'side_ss{s}', options['int'], (f'num_side_ss{s}',), chunksizes=chunks, **options['bulk'])
+        x[:] = sides
 
 #
 # this is direct from tdr, may need a way to do this from devsim in the future
-# write now we are only working in nodal data
+# this writes the nodal data
+# each state is written as a time step, with one state in memory at a time
 #
-def write_datasets_from_tdr(rootgrp, data):
-    #print(data['datasets'])
+def write_datasets_from_tdr(rootgrp, data, options):
+    #print(data.datasets)
     print("Merging TDR datasets")
-    datasets = data['datasets']
+    datasets = data.datasets
+    states = data.states
 
     to_create = {}
     oindex = 0
     for i, d in enumerate(datasets):
+        if d['location'] != read_tdr.location_vertex:
+            continue
         name = d['name']
         nrows = d['nrows']
 
@@ -126,17 +316,18 @@ def write_datasets_from_tdr(rootgrp, data):
                 oname = f'{name}_{j}'
             if oname not in to_create:
                 to_create[oname] = {
+                    'name' : name,
                     'oindex' : oindex,
-                    'dindex' : [],
+                    'dindex' : [[] for s in states],
                     'cindex' : j,
                 }
                 print(f'{oname} {oindex} {i} {j}')
                 oindex += 1
-            to_create[oname]['dindex'].append(i)
+            to_create[oname]['dindex'][d['state']].append(i)
 
     num_nod_var = len(to_create)
     if num_nod_var == 0:
-        print('no datasets to save into exodus')
+        print('no node datasets to save into exodus')
         return
     rootgrp.createDimension('num_nod_var', num_nod_var)
 
@@ -147,30 +338,122 @@ def write_datasets_from_tdr(rootgrp, data):
         nv[v['oindex']] = stringtoarr(k, rootgrp.dimensions['len_name'].size)
 
     num_nodes = rootgrp.dimensions['num_nodes'].size
+    # one time step of a variable is written at a time
+    chunks = (1,) + get_chunks(num_nodes)[:1]
+    for v in to_create.values():
+        oi = v['oindex'] + 1
+        v['variable'] = rootgrp.createVariable(f'vals_nod_var{oi}', 'f8', ('time_step', 'num_nodes'), chunksizes=chunks, **options['bulk'])
+
+    time_whole = rootgrp.variables['time_whole']
+    # the components of a vector are merged together, so each dataset is read once
+    by_name = {}
+    for v in to_create.values():
+        by_name.setdefault(v['name'], []).append(v)
     # Writing records
-    temp_array = np.empty(num_nodes)
+    for t, state in enumerate(states):
+        if len(states) > 1:
+            print(f'writing {state["name"]} at time {state["time"]:g}')
+        time_whole[t] = state['time']
+        for outputs in by_name.values():
+            temp_array = np.zeros((len(outputs), num_nodes))
+            for di in sorted(set(di for v in outputs for di in v['dindex'][t])):
+                dataset = datasets[di]
+                coordinate = data.regions[dataset['region']]['elements']['coordinates']
+                values = data.get_dataset_values(dataset)
+                for a, v in zip(temp_array, outputs):
+                    if di in v['dindex'][t]:
+                        # does not handle coincident nodes in adjacent blocks
+                        a[coordinate] = values[v['cindex'], :]
+                del values
+            for a, v in zip(temp_array, outputs):
+                v['variable'][t,:] = a
+
+#
+# element data is written per element block, for each element shape of a region
+# mixed element data is in the tdr element order, which the region 'order' maps to block order
+#
+def write_element_datasets_from_tdr(rootgrp, all_info, data, options):
+    datasets = data.datasets
+    states = data.states
+    blocks = get_element_blocks(all_info['region_info'])
+    region_blocks = {}
+    for b, x in enumerate(blocks):
+        region_blocks.setdefault(x[0], []).append(b)
+
+    to_create = {}
+    for i, d in enumerate(datasets):
+        if d['location'] != read_tdr.location_element:
+            continue
+        name = d['name']
+        nrows = d['nrows']
+
+        for j in range(nrows):
+            if nrows == 1:
+                oname = name
+            else:
+                oname = f'{name}_{j}'
+            if oname not in to_create:
+                to_create[oname] = {
+                    'oindex' : len(to_create),
+                    # dataset for each state and region
+                    'dindex' : [{} for s in states],
+                    'cindex' : j,
+                    'variables' : {},
+                }
+            to_create[oname]['dindex'][d['state']][d['region']] = i
+
+    num_elem_var = len(to_create)
+    if num_elem_var == 0:
+        return
+    print("Writing TDR element datasets")
+    rootgrp.createDimension('num_elem_var', num_elem_var)
+
+    nv = rootgrp.createVariable('name_elem_var', 'S1', ('num_elem_var', 'len_name'))
     for k, v in to_create.items():
-        temp_array[:] = 0.0
+        nv[v['oindex']] = stringtoarr(k, rootgrp.dimensions['len_name'].size)
+
+    # truth table of the variables on each block
+    truth = np.zeros((len(blocks), num_elem_var), dtype=np.int32)
+    for v in to_create.values():
+        for dindex in v['dindex']:
+            for r in dindex.keys():
+                truth[region_blocks[data.regions[r]['name']], v['oindex']] = 1
+    x = rootgrp.createVariable('elem_var_tab', 'i4', ('num_el_blk', 'num_elem_var'))
+    x[:,:] = truth
+
+    for v in to_create.values():
         oi = v['oindex'] + 1
-        #print(oi)
-        vv = rootgrp.createVariable(f'vals_nod_var{oi}', 'f8', ('time_step', 'num_nodes'))
-
-        ci = v['cindex']
-        for di in v['dindex']:
-            dataset = datasets[di]
-            coordinate = data['regions'][dataset['region']]['elements']['coordinates']
-            # does not handle coincident nodes in adjacent blocks
-            #print(temp_array.shape)
-            temp_array[coordinate] = dataset['values'][ci, :]
-            #print(temp_array.shape)
-            #print()
-        vv[0,:] = temp_array
+        for b in np.flatnonzero(truth[:, v['oindex']]):
+            dim = f'num_el_in_blk{b+1}'
+            chunks = (1,) + get_chunks(rootgrp.dimensions[dim].size)[:1]
+            v['variables'][b] = rootgrp.createVariable(f'vals_elem_var{oi}eb{b+1}', 'f8', ('time_step', dim), chunksizes=chunks, **options['bulk'])
+
+    time_whole = rootgrp.variables['time_whole']
+    for t, state in enumerate(states):
+        time_whole[t] = state['time']
+        # each dataset is read once for all of its components
+        for di in sorted(set(di for v in to_create.values() for di in v['dindex'][t].values())):
+            values = data.get_dataset_values(datasets[di])
+            region = data.regions[datasets[di]['region']]
+            order = region['elements'].get('order')
+            for v in to_create.values():
+                if v['dindex'][t].get(datasets[di]['region']) != di:
+                    continue
+                for b in region_blocks[region['name']]:
+                    name, shape, elements, start = blocks[b]
+                    if order is None:
+                        index = slice(start, start + len(elements))
+                    else:
+                        index = order[start:start + len(elements)]
+                    v['variables'][b][t,:] = values[v['cindex'], index]
+            del values
 
 # make sure to handle nodal and element data
-def write_exodus(filename, all_info, data):
+def write_exodus(filename, all_info, data, compression=None, shuffle=True, int64=None):
+    options = get_options(all_info, compression=compression, shuffle=shuffle, int64=int64)
     rootgrp = Dataset(filename, "w", format="NETCDF4")
-    write(rootgrp, all_info)
-    if 'datasets' in data:
-        write_datasets_from_tdr(rootgrp, data)
+    write(rootgrp, all_info, options)
+    if data.datasets is not None:
+        write_datasets_from_tdr(rootgrp, data, options)
+        write_element_datasets_from_tdr(rootgrp, all_info, data, options)
     rootgrp.close()
-
@@ -1,3 +1,7 @@
+import io
+import numpy as np
+from . import text_writer
+
 
 def write_MeshFormat(ofh):
     ofh.write('''$MeshFormat
@@ -15,28 +19,44 @@ def write_PhysicalNames(ofh, PhysicalGroups):
 def write_Nodes(ofh, coordinates):
     ofh.write('$Nodes\n')
     ofh.write('%d\n' % len(coordinates))
-    for i, v in enumerate(coordinates):
-        ofh.write('%d ' % (i + 1,))
-        ofh.write('%1.16g %1.16g %1.16g\n' % tuple(v))
+    text_writer.write_rows(ofh, '%d %1.16g %1.16g %1.16g\n', [coordinates], index_start=1)
     ofh.write('$EndNodes\n')
 
+# gmsh element type of each element shape
+# the tdr node order of each shape is the gmsh node order
+element_types = {
+    'points' : 15,
+    'edges' : 1,
+    'triangles' : 2,
+    'quadrangles' : 3,
+    'tetrahedra' : 4,
+    'hexahedra' : 5,
+    'prisms' : 6,
+    'pyramids' : 7,
+}
+
+def get_number_of_elements(either_info):
+    return sum([len(e) for x in either_info.values() for s, e in x.blocks])
+
 # info can be either boundary info or region info
 def write_element_info(ofh, PhysicalGroups, either_info, index):
     for name, info in either_info.items():
         group = PhysicalGroups[name]
-        # elm-type number-of-tags physical-tag elementary-tag mesh-partition
-        tag_info = [group.etype, 2, group.index, group.index]
-        tag_info_string = " ".join([str(x) for x in tag_info])
-        for element in info.elements:
-            ofh.write("%d %s " % (index, tag_info_string))
-            element_nodes = " ".join([str(x) for x in element])
-            ofh.write("%s\n" % (element_nodes))
-            index += 1
+        for shape, elements in info.blocks:
+            # elm-type number-of-tags physical-tag elementary-tag mesh-partition
+            tag_info = [element_types[shape], 2, group.index, group.index]
+            tag_info_string = " ".join([str(x) for x in tag_info])
+            elements = np.asarray(elements)
+            if len(elements) == 0:
+                continue
+            row_format = "%d " + tag_info_string + " " + " ".join(["%d"] * elements.shape[1]) + "\n"
+            # node numbers are 1 based
+            index += text_writer.write_rows(ofh, row_format, [elements], index_start=index, offset=1)
     return index
 
 def write_Elements(ofh, PhysicalGroups, region_info, boundary_info):
-    num_region_elements =  sum([len(x.elements) for x in region_info.values()])
-    num_boundary_elements = sum([len(x.elements) for x in boundary_info.values()])
+    num_region_elements = get_number_of_elements(region_info)
+    num_boundary_elements = get_number_of_elements(boundary_info)
     num_elements = num_region_elements + num_boundary_elements
     ofh.write('$Elements\n%d\n' % (num_elements,))
 
@@ -169,7 +189,7 @@ def get_coordinate_strings(coordinates):
 
 def get_element_coordinate_strings(coordinate_strings, elements, values):
     # values are constant over element
-    # element node indexes are 1 based
+    # element node indexes are 0 based
     element_strings = [None] * len(elements)
     if len(elements[0]) == 4:
         prefix = "SS" # scalar tetrahedron
@@ -182,7 +202,7 @@ def get_element_coordinate_strings(coordinate_strings, elements, values):
         nnodes = 2
 
     for i, element in enumerate(elements):
-        cstring = ", ".join([coordinate_strings[x-1] for x in element])
+        cstring = ", ".join([coordinate_strings[x] for x in element])
         vstring = ", ".join(["%g" % values[i]] * nnodes)
         element_strings[i] = "%s( %s) {%s};" % (prefix, cstring, vstring)
 
@@ -216,12 +236,161 @@ ds.create_gmsh_mesh(file="%s", mesh="%s")
         ofh.write('ds.finalize_mesh(mesh="%s")\n' % (device_name,))
         ofh.write('ds.create_device(mesh="%s", device="%s")\n' % (device_name, device_name))
 
-def write_gmsh(filename, all_info):
+#
+# binary formats
+# https://gmsh.info/doc/texinfo/gmsh.html#MSH-file-format
+#
+gmsh_formats = ('ascii22', 'binary22', 'binary41')
+
+def write_text(ofh, text):
+    ofh.write(text.encode('ascii'))
+
+def write_binary_MeshFormat(ofh, version):
+    write_text(ofh, '$MeshFormat\n%s 1 8\n' % version)
+    # the one is written in binary to detect endianness
+    np.array([1], dtype=np.int32).tofile(ofh)
+    write_text(ofh, '\n$EndMeshFormat\n')
+
+def write_binary_PhysicalNames(ofh, PhysicalGroups):
+    text = io.StringIO()
+    write_PhysicalNames(text, PhysicalGroups)
+    write_text(ofh, text.getvalue())
+
+def get_element_blocks(PhysicalGroups, region_info, boundary_info):
+    '''
+      Returns the (group, element type, elements) of each element shape of each physical group in file order
+    '''
+    blocks = []
+    for either_info in (boundary_info, region_info):
+        for name, info in either_info.items():
+            for shape, elements in info.blocks:
+                blocks.append((PhysicalGroups[name], element_types[shape], np.asarray(elements)))
+    return blocks
+
+def write_binary22_Nodes(ofh, coordinates):
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    nodes = np.empty(len(coordinates), dtype=[('index', np.int32), ('coordinates', np.float64, (3,))])
+    nodes['index'] = np.arange(1, len(coordinates) + 1)
+    nodes['coordinates'] = coordinates
+    write_text(ofh, '$Nodes\n%d\n' % len(coordinates))
+    nodes.tofile(ofh)
+    write_text(ofh, '\n$EndNodes\n')
+
+def write_binary22_Elements(ofh, blocks):
+    num_elements = sum([len(x[2]) for x in blocks])
+    write_text(ofh, '$Elements\n%d\n' % num_elements)
+    index = 1
+    for group, etype, elements in blocks:
+        if len(elements) == 0:
+            continue
+        # elm-type num-elm-follow num-tags
+        np.array([etype, len(elements), 2], dtype=np.int32).tofile(ofh)
+        # number physical-tag elementary-tag node-number-list
+        table = np.empty((len(elements), 3 + elements.shape[1]), dtype=np.int32)
+        table[:, 0] = np.arange(index, index + len(elements))
+        table[:, 1:3] = group.index
+        table[:, 3:] = elements
+        # node numbers are 1 based
+        table[:, 3:] += 1
+        table.tofile(ofh)
+        index += len(elements)
+    write_text(ofh, '\n$EndElements\n')
+
+def write_binary41_Entities(ofh, coordinates, blocks):
+    '''
+      each physical group is written as its own entity, with the group index as its tag
+    '''
+    entities = [{}, {}, {}, {}]
+    for group, etype, elements in blocks:
+        entities[group.dim].setdefault(group.index, (group, []))[1].append(elements)
+    write_text(ofh, '$Entities\n')
+    np.array([len(x) for x in entities], dtype=np.uint64).tofile(ofh)
+    for dim, x in enumerate(entities):
+        for group, tables in x.values():
+            tables = [e for e in tables if len(e)]
+            if tables:
+                bounds = [coordinates[e.ravel()] for e in tables]
+                bounds = np.concatenate((np.min([b.min(axis=0) for b in bounds], axis=0), np.max([b.max(axis=0) for b in bounds], axis=0)))
+            else:
+                bounds = np.zeros(6)
+            np.array([group.index], dtype=np.int32).tofile(ofh)
+            # points only have their coordinates
+            if dim == 0:
+                bounds[:3].tofile(ofh)
+            else:
+                bounds.tofile(ofh)
+            np.array([1], dtype=np.uint64).tofile(ofh)
+            np.array([group.index], dtype=np.int32).tofile(ofh)
+            if dim != 0:
+                # no bounding entities
+                np.array([0], dtype=np.uint64).tofile(ofh)
+    write_text(ofh, '\n$EndEntities\n')
+
+def write_binary41_Nodes(ofh, coordinates, blocks):
+    '''
+      all nodes are written in one block on the first entity of highest dimension
+    '''
+    group = max([x[0] for x in blocks], key=lambda x: x.dim)
+    num_nodes = len(coordinates)
+    write_text(ofh, '$Nodes\n')
+    # numEntityBlocks numNodes minNodeTag maxNodeTag
+    np.array([1, num_nodes, 1, num_nodes], dtype=np.uint64).tofile(ofh)
+    # entityDim entityTag parametric numNodesInBlock
+    np.array([group.dim, group.index, 0], dtype=np.int32).tofile(ofh)
+    np.array([num_nodes], dtype=np.uint64).tofile(ofh)
+    np.arange(1, num_nodes + 1, dtype=np.uint64).tofile(ofh)
+    coordinates.tofile(ofh)
+    write_text(ofh, '\n$EndNodes\n')
+
+def write_binary41_Elements(ofh, blocks):
+    blocks = [x for x in blocks if len(x[2])]
+    num_elements = sum([len(x[2]) for x in blocks])
+    write_text(ofh, '$Elements\n')
+    # numEntityBlocks numElements minElementTag maxElementTag
+    np.array([len(blocks), num_elements, 1, num_elements], dtype=np.uint64).tofile(ofh)
+    index = 1
+    for group, etype, elements in blocks:
+        # entityDim entityTag elementType numElementsInBlock
+        np.array([group.dim, group.index, etype], dtype=np.int32).tofile(ofh)
+        np.array([len(elements)], dtype=np.uint64).tofile(ofh)
+        # elementTag nodeTag ...
+        table = np.empty((len(elements), 1 + elements.shape[1]), dtype=np.uint64)
+        table[:, 0] = np.arange(index, index + len(elements))
+        table[:, 1:] = elements
+        # node numbers are 1 based
+        table[:, 1:] += 1
+        table.tofile(ofh)
+        index += len(elements)
+    write_text(ofh, '\n$EndElements\n')
+
+def write_binary_mesh(ofh, coordinates, PhysicalGroups, region_info, boundary_info, version):
+    coordinates = np.ascontiguousarray(coordinates, dtype=np.float64)
+    blocks = get_element_blocks(PhysicalGroups, region_info, boundary_info)
+    write_binary_MeshFormat(ofh, version)
+    write_binary_PhysicalNames(ofh, PhysicalGroups)
+    if version == '2.2':
+        write_binary22_Nodes(ofh, coordinates)
+        write_binary22_Elements(ofh, blocks)
+    elif version == '4.1':
+        write_binary41_Entities(ofh, coordinates, blocks)
+        write_binary41_Nodes(ofh, coordinates, blocks)
+        write_binary41_Elements(ofh, blocks)
+    else:
+        raise RuntimeError("Unexpected gmsh version " + version)
+
+def write_gmsh(filename, all_info, gmsh_format='ascii22'):
     coordinates = all_info['coordinates']
     groups      = all_info['groups']
     region_info = all_info['region_info']
     boundary_info = all_info['boundary_info']
     # write out the mesh
-    with open(filename, "w") as ofh:
-        write_mesh(ofh, coordinates=coordinates, PhysicalGroups=groups, region_info=region_info, boundary_info=boundary_info)
+    if gmsh_format == 'ascii22':
+        with open(filename, "w") as ofh:
+            write_mesh(ofh, coordinates=coordinates, PhysicalGroups=groups, region_info=region_info, boundary_info=boundary_info)
+    elif gmsh_format in ('binary22', 'binary41'):
+        version = '2.2' if gmsh_format == 'binary22' else '4.1'
+        with open(filename, "wb") as ofh:
+            write_binary_mesh(ofh, coordinates=coordinates, PhysicalGroups=groups, region_info=region_info, boundary_info=boundary_info, version=version)
+    else:
+        raise RuntimeError("Unexpected gmsh format " + gmsh_format)
 
@@ -1,11 +1,21 @@
+import numpy as np
+from . import text_writer
+
 #http://wias-berlin.de/software/tetgen/1.5/doc/manual/manual006.html#ff_node
 # Node count, 3 dim, no attribute, no boundary marker
 # Node index, node coordinates
 def write_tetgen_nodes(ofh, coordinates):
     ofh.write("%d %d 0 0\n" % (len(coordinates), 3))
-    for i, v in enumerate(coordinates):
-        ofh.write('%d ' % (i + 1,))
-        ofh.write('%1.16g %1.16g %1.16g\n' % tuple(v))
+    text_writer.write_rows(ofh, '%d %1.16g %1.16g %1.16g\n', [coordinates], index_start=1)
+
+# <index> <node> ... <node> <tag>
+def write_tagged_elements(ofh, elements, tag, index):
+    elements = np.asarray(elements)
+    if len(elements) == 0:
+        return index
+    row_format = '%d ' + ' '.join(['%d'] * elements.shape[1]) + ' ' + str(tag) + '\n'
+    # node numbers are 1 based
+    return index + text_writer.write_rows(ofh, row_format, [elements], index_start=index, offset=1)
 
 #http://wias-berlin.de/software/tetgen/1.5/doc/manual/manual006.html#ff_ele
 #First line: <# of tetrahedra> <nodes per tet. (4 or 10)> <region attribute (0 or 1)>
@@ -17,11 +27,7 @@ def write_tetgen_elements(ofh, PhysicalGroups, region_info):
     index = 1
     for name, info in region_info.items():
         region_index = PhysicalGroups[name].index
-        for element in info.elements:
-            ofh.write('%d ' % index)
-            ofh.write(' '.join([str(x) for x in element]))
-            ofh.write(' %d\n' % region_index)
-            index += 1
+        index = write_tagged_elements(ofh, info.elements, region_index, index)
 
 
 #http://wias-berlin.de/software/tetgen/1.5/doc/manual/manual006.html#ff_face
@@ -34,11 +40,7 @@ def write_tetgen_faces(ofh, PhysicalGroups, boundary_info):
     index = 1
     for name, info in boundary_info.items():
         boundary_index = PhysicalGroups[name].index
-        for element in info.elements:
-            ofh.write('%d ' % index)
-            ofh.write(' '.join([str(x) for x in element]))
-            ofh.write(' %d\n' % boundary_index)
-            index += 1
+        index = write_tagged_elements(ofh, info.elements, boundary_index, index)
 
 # http://wias-berlin.de/software/tetgen/1.5/doc/manual/manual006.html#ff_vol
 def write_vol_file(filename, values, all_info):
@@ -48,14 +50,24 @@ def write_vol_file(filename, values, all_info):
             elements = region_info.elements
             out_values.extend(values[region])
         ofh.write('%d\n' % len(out_values))
-        for i, v in enumerate(out_values):
-            ofh.write('%d %g\n' % (i+1,v))
+        text_writer.write_rows(ofh, '%d %g\n', [np.asarray(out_values, dtype=np.float64)], index_start=1)
+
+def check_shapes(either_info):
+    '''
+      tetgen files only have simplex elements
+    '''
+    for name, info in either_info.items():
+        for shape, elements in info.blocks:
+            if shape not in ('edges', 'triangles', 'tetrahedra'):
+                raise RuntimeError("tetgen does not support the %s of %s" % (shape, name))
 
 def write_tetgen(basename, all_info):
     coordinates = all_info['coordinates']
     groups      = all_info['groups']
     region_info = all_info['region_info']
     boundary_info = all_info['boundary_info']
+    check_shapes(region_info)
+    check_shapes(boundary_info)
     # write out the mesh
     with open(basename + '.node', 'w') as ofh:
         write_tetgen_nodes(ofh, coordinates)
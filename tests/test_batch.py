@@ -0,0 +1,46 @@
+#
+# Batch conversion, where one file failing or killing its process does not stop the others
+#
+import contextlib
+import io
+import multiprocessing
+import os
+import pytest
+
+from tdrconvert import synthetic_tdr
+from tdrconvert import tdr_convert
+
+def write_files(tmp_path, count):
+    for i in range(count):
+        synthetic_tdr.write_synthetic_tdr(str(tmp_path / ('device_%d.tdr' % i)), synthetic_tdr.get_cells(2, 200))
+
+def convert_batch(tmp_path, batch_jobs):
+    args = tdr_convert.get_parser().parse_args([
+        '--batch', str(tmp_path / '*.tdr'),
+        '--gmsh', str(tmp_path / 'out' / '{stem}.msh'),
+        '--batch_jobs', str(batch_jobs),
+    ])
+    with contextlib.redirect_stdout(io.StringIO()):
+        return tdr_convert.convert_batch(args)
+
+def test_failed_file(tmp_path):
+    write_files(tmp_path, 3)
+    (tmp_path / 'bad.tdr').write_bytes(b'not a tdr file')
+    failures = convert_batch(tmp_path, 2)
+    assert [os.path.basename(x['tdr']) for x in failures] == ['bad.tdr']
+    assert sorted(os.listdir(tmp_path / 'out')) == ['device_%d.msh' % i for i in range(3)]
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason='the patched convert is only seen by forked processes')
+def test_process_killed(tmp_path, monkeypatch):
+    write_files(tmp_path, 6)
+    convert = tdr_convert.convert
+    def convert_or_exit(args):
+        if args.tdr.endswith('device_2.tdr'):
+            os._exit(1)
+        return convert(args)
+    monkeypatch.setattr(tdr_convert, 'convert', convert_or_exit)
+
+    failures = convert_batch(tmp_path, 3)
+    assert [os.path.basename(x['tdr']) for x in failures] == ['device_2.tdr']
+    assert 'exited with code 1' in failures[0]['error']
+    assert sorted(os.listdir(tmp_path / 'out')) == ['device_%d.msh' % i for i in range(6) if i != 2]
@@ -0,0 +1,22 @@
+#
+# Rows formatted with numpy are the same as with %
+#
+import io
+import numpy
+
+from tdrconvert import text_writer
+
+def write(row_format, columns, **kwargs):
+    ofh = io.StringIO()
+    text_writer.write_rows(ofh, row_format, columns, chunk_size=7, **kwargs)
+    return ofh.getvalue()
+
+def test_integer_rows():
+    elements = numpy.array([0, 9, 10, 9999, 10000, 99999999, 100000000, 123456789012]).reshape(-1, 2)
+    expected = ''.join(['%d 2 %d %d 7\n' % (i + 3, x + 1, y + 1) for i, (x, y) in enumerate(elements)])
+    assert write('%d 2 %d %d 7\n', [elements], index_start=3, offset=1) == expected
+
+def test_int32_offset():
+    elements = numpy.array([[2**31 - 1, 0]], dtype=numpy.int32)
+    assert write('%d %d\n', [elements], offset=1) == '2147483648 1\n'
+    assert write('%d %g\n', [elements[:, :1], numpy.array([0.5])], offset=1) == '2147483648 1.5\n'
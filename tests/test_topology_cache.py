@@ -0,0 +1,58 @@
+#
+# The topology cache shared by processes converting at the same time
+#
+import concurrent.futures
+import contextlib
+import io
+import multiprocessing
+import os
+
+from tdrconvert import read_tdr
+from tdrconvert import synthetic_tdr
+from tdrconvert import topology_cache
+
+def read_cached(filenames, cache_dir, cache_size, repeat):
+    '''
+      reads every file repeat times, with a cache which holds about one entry, so the processes keep evicting each other's entries
+    '''
+    nodes = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(repeat):
+            for filename in filenames:
+                with read_tdr.read_tdr(filename, 1.0, False, cache_dir=cache_dir, cache_size=cache_size) as mesh:
+                    nodes.append(len(mesh.coordinates))
+    return nodes
+
+def write_files(tmp_path, count):
+    filenames = []
+    for i in range(count):
+        filename = str(tmp_path / ('device_%d.tdr' % i))
+        synthetic_tdr.write_synthetic_tdr(filename, synthetic_tdr.get_cells(2, 200 + 50 * i))
+        filenames.append(filename)
+    return filenames
+
+def test_concurrent_processes(tmp_path):
+    filenames = write_files(tmp_path, 4)
+    cache_dir = str(tmp_path / 'cache')
+    with contextlib.redirect_stdout(io.StringIO()):
+        expected = read_cached(filenames, None, None, 1)
+        read_cached(filenames[:1], cache_dir, None, 1)
+    cache_size = os.path.getsize(os.path.join(cache_dir, os.listdir(cache_dir)[0]))
+
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=8, mp_context=context) as executor:
+        futures = [executor.submit(read_cached, filenames, cache_dir, cache_size, 5) for i in range(8)]
+        for x in futures:
+            assert x.result() == expected * 5
+
+def test_unreadable_entry_is_a_miss(tmp_path):
+    filename = write_files(tmp_path, 1)[0]
+    cache_dir = str(tmp_path / 'cache')
+    key = topology_cache.get_cache_key(filename, 1.0, False)
+    os.makedirs(cache_dir)
+    with open(topology_cache.get_cache_filename(cache_dir, key), 'wb') as ofh:
+        ofh.write(b'not an npz file')
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert topology_cache.load_topology(cache_dir, key) is None
+        assert topology_cache.load_topology(cache_dir, 'missing') is None
+        topology_cache.evict(str(tmp_path / 'missing'), 0)